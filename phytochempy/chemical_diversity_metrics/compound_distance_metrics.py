@@ -1,7 +1,126 @@
+from functools import lru_cache
+
+import numpy as np
 import pandas as pd
 from rdkit.Chem import rdFingerprintGenerator
 
-_mfpgen = rdFingerprintGenerator.GetMorganGenerator(radius=2, fpSize=2048)
+_FP_SIZE = 2048
+_mfpgen = rdFingerprintGenerator.GetMorganGenerator(radius=2, fpSize=_FP_SIZE)
+
+# Number of set bits in each possible byte, for numpy versions without np.bitwise_count
+_BYTE_POPCOUNTS = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _popcount_rows(words: np.ndarray) -> np.ndarray:
+    """
+    Count the set bits in each row of a packed uint64 fingerprint array.
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return _BYTE_POPCOUNTS[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+@lru_cache(maxsize=4096)
+def _smiles_to_fp(smiles: str):
+    """
+    Produce a hashed Morgan fingerprint for a SMILES string. A small number of recent results are cached so repeated calculations (e.g.
+    for different groupings or subsamples of the same data) don't parse and fingerprint the same compounds again, without keeping
+    fingerprints for whole datasets in memory.
+
+    :param smiles: The SMILES string.
+    :return: The fingerprint (ExplicitBitVect), or None if the SMILES could not be parsed.
+    """
+    from rdkit import Chem
+
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        return None
+    return _mfpgen.GetFingerprint(mol)
+
+
+def _fingerprints_for(smiles: pd.Series) -> list:
+    """
+    Produce a hashed Morgan fingerprint for each SMILES string.
+
+    Parameters:
+    smiles (pd.Series): The SMILES strings to fingerprint.
+
+    Returns:
+    list: The fingerprints (ExplicitBitVect), aligned with the given SMILES. None where a SMILES could not be parsed.
+    """
+    return [_smiles_to_fp(s) if isinstance(s, str) else None for s in smiles]
+
+
+def _fps_to_u64_matrix(fps: list) -> np.ndarray:
+    """
+    Pack fingerprints into a 2-D uint64 array, one row per fingerprint (shape [n, 32] for 2048 bit fingerprints).
+
+    Parameters:
+    fps (list): The fingerprints (ExplicitBitVect) to pack.
+
+    Returns:
+    np.ndarray: The packed fingerprint matrix.
+    """
+    from rdkit import DataStructs
+
+    packed = b''.join(DataStructs.BitVectToBinaryText(fp) for fp in fps)
+    return np.frombuffer(packed, dtype=np.uint64).reshape(len(fps), _FP_SIZE // 64)
+
+
+def _bulk_tanimoto_u64(fp_matrix: np.ndarray) -> np.ndarray:
+    """
+    Calculate the Tanimoto distances between all rows of a packed fingerprint matrix, using vectorised popcounts over the uint64 words.
+
+    Returns the lower triangle elements of the symmetric distance matrix, in the same order as rdkit's GetTanimotoDistMat.
+
+    Parameters:
+    fp_matrix (np.ndarray): The packed fingerprint matrix, as given by _fps_to_u64_matrix.
+
+    Returns:
+    np.ndarray: The pairwise distances.
+    """
+    # Count bits of each fingerprint once, so only the intersection needs counting for each pair
+    popcounts = _popcount_rows(fp_matrix)
+    distances = [np.empty(0)]
+    for i in range(1, len(fp_matrix)):
+        intersection = _popcount_rows(fp_matrix[i] & fp_matrix[:i])
+        union = popcounts[i] + popcounts[:i] - intersection
+        # As in rdkit, the similarity of two empty fingerprints is 0
+        similarity = np.divide(intersection, union, out=np.zeros(i), where=union > 0)
+        distances.append(1 - similarity)
+    return np.concatenate(distances)
+
+
+def _fad_sum_direct(fp_matrix: np.ndarray, max_pairs: int = 1 << 16) -> float:
+    """
+    Calculate the sum of the Tanimoto distances between all pairs of rows of a packed fingerprint matrix, i.e. the sum of the lower triangle
+    elements of the symmetric distance matrix.
+
+    As only the sum is needed for FAD measures, the distance matrix itself is never materialised. Rows are instead compared in blocks
+    of roughly max_pairs pairs at a time, so the number of interpreter-level iterations stays small while memory use stays bounded.
+
+    Parameters:
+    fp_matrix (np.ndarray): The packed fingerprint matrix, as given by _fps_to_u64_matrix.
+    max_pairs (int): The approximate number of pairs compared in each block.
+
+    Returns:
+    float: The sum of the pairwise distances.
+    """
+    n = len(fp_matrix)
+    popcounts = _popcount_rows(fp_matrix)
+    block_size = max(1, max_pairs // max(n, 1))
+    total = 0.0
+    for start in range(0, n - 1, block_size):
+        stop = min(start + block_size, n - 1)
+        # Compare rows start..stop-1 against every later row
+        intersection = _popcount_rows(fp_matrix[start:stop, None, :] & fp_matrix[None, start + 1:, :])
+        union = popcounts[start:stop, None] + popcounts[None, start + 1:] - intersection
+        similarity = np.divide(intersection, union, out=np.zeros(intersection.shape), where=union > 0)
+        # Only keep pairs (i, j) with j > i
+        upper = np.arange(n - start - 1)[None, :] >= np.arange(stop - start)[:, None]
+        total += float((1 - similarity)[upper].sum())
+    return total
+
 
 def _get_pairwise_distances_from_data(df: pd.DataFrame):
     """
@@ -24,17 +143,9 @@ def _get_pairwise_distances_from_data(df: pd.DataFrame):
     distmat = _get_pairwise_distances_from_data(df)
     """
 
-    from rdkit.Chem import PandasTools
-    from rdkit.Chem.rdMolDescriptors import GetMorganFingerprintAsBitVect
-    from rdkit.DataManip.Metric import GetTanimotoDistMat
-
-    PandasTools.AddMoleculeColumnToFrame(df, 'Standard_SMILES', 'Molecule', includeFingerprints=True)
-    df = df.dropna(subset=['Molecule'])[['Molecule', 'Standard_SMILES']]
-
-
-    # Produce a hashed Morgan fingerprint for each molecule
-    df['morgan_fingerprint'] = df['Molecule'].apply(lambda x: _mfpgen.GetFingerprint(x))
-    distmat = GetTanimotoDistMat(df['morgan_fingerprint'].values)
+    # Produce a hashed Morgan fingerprint for each molecule, ignoring those that can't be parsed
+    fps = [fp for fp in _fingerprints_for(df['Standard_SMILES']) if fp is not None]
+    distmat = _bulk_tanimoto_u64(_fps_to_u64_matrix(fps))
 
     return distmat
 
@@ -78,32 +189,34 @@ def calculate_FAD_measures(df: pd.DataFrame, compound_grouping: str):
 
     df = remove_groups_with_single_compounds(df, compound_grouping)
 
-    groups = df.groupby(compound_grouping)
+    # Fingerprint every compound once up front, rather than once per group
+    fps = _fingerprints_for(df['Standard_SMILES'])
+
+    # Factorise the groups to integer codes once, and partition row positions by code with a single stable sort.
+    # Rows with a missing group have code -1, so are sorted first and skipped.
+    codes, taxa = pd.factorize(df[compound_grouping], sort=True)
+    order = np.argsort(codes, kind='stable')
+    group_sizes = np.bincount(codes[codes >= 0], minlength=len(taxa))
+    group_ends = np.cumsum(group_sizes) + np.count_nonzero(codes < 0)
     results = []
 
-    for taxon, taxon_data in groups:
-        N = len(taxon_data)
+    for taxon, N, end in zip(taxa, group_sizes, group_ends):
+        taxon_idx = order[end - N:end]
         if N < 2:
             raise ValueError(
                 f'Measures for taxa with single compounds are poorly defined. '
                 f'In this case for taxon "{taxon}", '
                 f'either remove these from your data, or make a pull request :)'
             )
-        distances = _get_pairwise_distances_from_data(taxon_data)
-        FAD = distances.sum() * 2
-        num_distances = len(distances) * 2
-        assert num_distances == N ** 2 - N
+        taxon_fps = [fps[i] for i in taxon_idx if fps[i] is not None]
+        assert len(taxon_fps) == N
+        FAD = _fad_sum_direct(_fps_to_u64_matrix(taxon_fps)) * 2
+        num_distances = N ** 2 - N
         MFAD = FAD / N
         APWD = FAD / num_distances
 
-        results.append({
-            compound_grouping: taxon,
-            'FAD': FAD,
-            'MFAD': MFAD,
-            'APWD': APWD,
-            'GroupSize_FAD': N
-        })
+        results.append((taxon, FAD, MFAD, APWD, N))
 
-    out_df = pd.DataFrame(results)
+    out_df = pd.DataFrame.from_records(results, columns=[compound_grouping, 'FAD', 'MFAD', 'APWD', 'GroupSize_FAD'])
 
     return out_df
@@ -8,6 +8,17 @@ from phytochempy.compound_properties import get_npclassifier_pathway_columns_in_
 from phytochempy.data_compilation_utilities import get_pathway_version_resolved_at_taxon_level
 
 
+def _xlogx(x: np.ndarray) -> np.ndarray:
+    """
+    Calculate x * ln(x) elementwise, where 0 * ln(0) is taken to be 0 (as in scipy.special.xlogy(x, x)).
+
+    :param x: An array of non-negative values.
+    :return: An array of x * ln(x) values.
+    """
+    x = np.asarray(x, dtype=float)
+    return x * np.log(x, out=np.zeros(x.shape), where=x > 0)
+
+
 def split_multiple_pathways_into_duplicate_rows(df: pd.DataFrame) -> pd.DataFrame:
     """
     Resolve cases with multiple assinged compounds by separating into different rows
@@ -15,36 +26,18 @@ def split_multiple_pathways_into_duplicate_rows(df: pd.DataFrame) -> pd.DataFram
     :param df: A pandas DataFrame containing multiple pathways encoded as binary values.
     :return: A pandas DataFrame with duplicate rows created for each pathway that has multiple occurrences.
     """
-    issues_to_resolve = df[df[NP_PATHWAYS].sum(axis=1) > 1]
-    if len(issues_to_resolve) > 0:
-        # List to store new rows
-        new_rows = []
-
-        # Iterate through each row in the dataframe
-        for index, row in issues_to_resolve.iterrows():
-            # Count the number of 1s in the row
-            count_ones = row[NP_PATHWAYS].sum()
-
-            # If more than one 1 is found
-            if count_ones > 1:
-                one_cols = []
-                for col in NP_PATHWAYS:
-                    if row[col] == 1:
-                        one_cols.append(col)
-                # Iterate through each column in the row
-                for col in one_cols:
-
-                    new_row = row.copy()
-                    for p in NP_PATHWAYS:
-                        new_row[p] = 0
-                    new_row[col] = 1
-                    new_rows.append(new_row.T)
-
-        # Add new rows to dataframe
-        resolution_df = pd.DataFrame()._append(new_rows)
+    pathway_matrix = df[NP_PATHWAYS].to_numpy()
+    multiple = pathway_matrix.sum(axis=1) > 1
+    if multiple.any():
+        # Positions of each row with multiple pathways, repeated once for each of its assigned pathways
+        row_positions, pathway_positions = np.nonzero(pathway_matrix[multiple] == 1)
+        resolution_df = df.iloc[np.flatnonzero(multiple)[row_positions]].copy()
+
+        # Each new row is assigned to just one of the original pathways
+        resolution_df[NP_PATHWAYS] = np.eye(len(NP_PATHWAYS), dtype=pathway_matrix.dtype)[pathway_positions]
         assert len(resolution_df[resolution_df[NP_PATHWAYS].sum(axis=1) > 1]) == 0
         # Drop duplicate rows
-        df = df[df[NP_PATHWAYS].sum(axis=1) < 2]
+        df = df[~multiple]
 
         out_df = pd.concat([df, resolution_df])
 
@@ -99,10 +92,9 @@ def separate_into_pathway(df: pd.DataFrame, pathway: str) -> tuple[DataFrame, An
     df = df.dropna(subset=['NPclassif_pathway_results'])
     pathway_cols = get_npclassifier_pathway_columns_in_df(df)
 
-    positives = pd.DataFrame()
-    for col in pathway_cols:
-        positives = pd.concat([positives, df[df[col] == pathway]])
-    negatives = df[~df.index.isin(positives.index)]
+    is_pathway = (df[pathway_cols].to_numpy() == pathway).any(axis=1)
+    positives = df[is_pathway]
+    negatives = df[~is_pathway]
     assert len(positives) + len(negatives) == len(df)
     problems = positives[~positives['NPclassif_pathway_results'].str.contains(pathway)]
     assert len(problems) == 0
@@ -112,6 +104,17 @@ def separate_into_pathway(df: pd.DataFrame, pathway: str) -> tuple[DataFrame, An
     return positives, negatives
 
 
+def _pathway_indicator_matrix(df: pd.DataFrame) -> np.ndarray:
+    """
+    One-hot encode the NPclassifier pathways of each compound.
+
+    :param df: A DataFrame containing NPclassifier pathway columns.
+    :return: An integer array of shape [len(df), len(NP_PATHWAYS)], 1 where the pathway is given in any of the pathway columns.
+    """
+    pathway_vals = df[get_npclassifier_pathway_columns_in_df(df)].to_numpy()
+    return np.stack([(pathway_vals == pathway).any(axis=1) for pathway in NP_PATHWAYS], axis=1).astype(int)
+
+
 def add_pathway_information_columns(df: pd.DataFrame, compound_id_col: str) -> pd.DataFrame:
     """
     Add pathway information columns to a DataFrame.
@@ -120,29 +123,69 @@ def add_pathway_information_columns(df: pd.DataFrame, compound_id_col: str) -> p
     :return: The DataFrame with pathway information columns added.
     """
     df = df.dropna(subset=['NPclassif_pathway_results'])
-    original_length = len(df)
+    ohe_df = pd.DataFrame(_pathway_indicator_matrix(df), columns=NP_PATHWAYS, index=df.index)
 
+    # A check that comps with same ID have been assigned same class
+    grouped = ohe_df.groupby(df[compound_id_col].to_numpy(), dropna=False)
+    ambiguous = grouped.min() != grouped.max()
     for pathway in NP_PATHWAYS:
-        relevant_paths, other_paths = separate_into_pathway(df, pathway)
-        relevant_paths[pathway] = 1
-        other_paths[pathway] = 0
-
-        pathway_df = pd.concat([relevant_paths, other_paths])[[compound_id_col, pathway]]
-        pathway_df = pathway_df.drop_duplicates(subset=[compound_id_col, pathway])
-        amibiguous_duplicates = pathway_df[pathway_df[compound_id_col].duplicated(keep=False)]
-        if len(amibiguous_duplicates) > 0:  # A check that comps with same ID have been assigned same class
+        if ambiguous[pathway].any():
+            pathway_df = pd.concat([df[compound_id_col], ohe_df[pathway]], axis=1).drop_duplicates(subset=[compound_id_col, pathway])
+            amibiguous_duplicates = pathway_df[pathway_df[compound_id_col].duplicated(keep=False)]
             print(
                 f'WARNING: Some ambiguity for pathway: {pathway}. This is likely due to differing smiles strings for same given {compound_id_col}.')
             print(amibiguous_duplicates)
 
             raise ValueError
 
-        df = df.merge(pathway_df, how='left', on=compound_id_col)
-    assert len(df) == original_length  # Check no additions from merge
+    df = pd.concat([df, ohe_df], axis=1).reset_index(drop=True)
 
     return df
 
 
+def _diversity_indices(count_vals: np.ndarray, total_counts: np.ndarray) -> tuple:
+    """
+    Calculate pathway diversity indices from pathway counts, for one or more groups of compounds.
+
+    :param count_vals: An array of shape [groups, len(NP_PATHWAYS)] giving the number of compounds identified as each pathway in each group.
+    :param total_counts: An array of shape [groups] giving the number of identified compounds in each group.
+    :return: A tuple of arrays (H, Hbc, G, J), each of shape [groups].
+    """
+    total_counts = np.asarray(total_counts, dtype=float)
+    mean_vals = count_vals / total_counts[:, None]
+
+    # ---- Shannon index (H) ----
+    shannon = -_xlogx(mean_vals).sum(axis=1)
+
+    ## Bias corrected shannon
+    # From chao_nonparametric_2003, following beck_comparing_2010.
+    # Note that there are updated metrics for calculating coverage e.g. chao_coveragebased_2012
+    singletons = (count_vals == 1).sum(axis=1)
+    sample_coverage = 1 - (singletons / total_counts)
+
+    # Coverage adjusted means, computed once and reused in each part of the term
+    # 1 - (1 - cm) ** n is evaluated as -expm1(n * log1p(-cm)) for accuracy when cm is small
+    coverage_adjusted_means = mean_vals * sample_coverage[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        additions = _xlogx(coverage_adjusted_means) / -np.expm1(total_counts[:, None] * np.log1p(-coverage_adjusted_means))
+    bias_corrected_shannon = -np.where(np.isnan(additions), 0, additions).sum(axis=1)
+
+    # Simpson index also refered to as gini-simpson
+    # Used in e.g. corre_evaluation_2023
+    simpson = 1 - (mean_vals * mean_vals).sum(axis=1)
+
+    number_of_apparent_categories = (count_vals > 0).sum(axis=1)
+
+    ## Pielou index measures evenness of the classes
+    ## It normalises H by the 'richness' for the given genus, i.e. the number of different pathways present
+    ## as discussed in corre_evaluation_2023.
+    ## Where number_of_apparent_categories =1, this is left undefined
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pielou = shannon / np.log(number_of_apparent_categories)
+
+    return shannon, bias_corrected_shannon, simpson, pielou
+
+
 def get_pathway_based_diversity_measures(df: pd.DataFrame, compound_grouping: str, compound_id_col: str) -> pd.DataFrame:
     """
 
@@ -178,48 +221,12 @@ def get_pathway_based_diversity_measures(df: pd.DataFrame, compound_grouping: st
     measure_df = get_group_level_version_for_all_pathways(group_compound_data_with_ohe_pathways, compound_grouping=compound_grouping,
                                                           use_distinct=True)
 
-    ### Begin with Shannon index
-    # Gather all relevant column names in advance for easy access
-    mean_cols = [f'mean_identified_as_{p}' for p in NP_PATHWAYS]
     count_cols = [f'identified_{p}_count' for p in NP_PATHWAYS]
-
-    # ---- Shannon index (H) ----
-    mean_vals = measure_df[mean_cols]
-    ln_mean_vals = np.log(mean_vals).replace(-np.inf, 0)
-    shannon = -(mean_vals * ln_mean_vals).sum(axis=1)
-    measure_df['H'] = shannon
-
-    ## Bias corrected shannon
-    # From chao_nonparametric_2003, following beck_comparing_2010.
-    # Note that there are updated metrics for calculating coverage e.g. chao_coveragebased_2012
-    singletons = (measure_df[count_cols] == 1).sum(axis=1)
-    measure_df['number_singletons'] = singletons
-    measure_df['sample_coverage'] = 1 - (singletons / measure_df['identified_compounds_count'])
-
-    measure_df['Hbc'] = 0
-    for pathway in NP_PATHWAYS:
-        ###New log
-        measure_df[f'ln_Cmean_identified_as_{pathway}'] = np.log(
-            measure_df[f'mean_identified_as_{pathway}'] * measure_df['sample_coverage'])
-        addition = ((measure_df[f'mean_identified_as_{pathway}'] * measure_df['sample_coverage'] * measure_df[f'ln_Cmean_identified_as_{pathway}']) /
-                    (1 - (1 - measure_df[f'mean_identified_as_{pathway}'] * measure_df['sample_coverage']) ** measure_df[
-                        'identified_compounds_count'])).fillna(0)
-        measure_df['Hbc'] = measure_df['Hbc'] + addition
-    measure_df['Hbc'] = -measure_df['Hbc']
-
-    # Simpson index also refered to as gini-simpson
-    # Used in e.g. corre_evaluation_2023
-    simpson = 1 - (mean_vals ** 2).sum(axis=1)
-    measure_df['G'] = simpson
-
-    bin_identified = (measure_df[count_cols] > 0).astype(int)
-    measure_df['number_of_apparent_categories'] = bin_identified.sum(axis=1)
-
-    ## Pielou index measures evenness of the classes
-    ## It normalises H by the 'richness' for the given genus, i.e. the number of different pathways present
-    ## as discussed in corre_evaluation_2023.
-    ## Where number_of_apparent_categories =1, this is left undefined
-    measure_df['J'] = measure_df['H'] / (np.log(measure_df['number_of_apparent_categories']))
+    H, Hbc, G, J = _diversity_indices(measure_df[count_cols].to_numpy(), measure_df['identified_compounds_count'].to_numpy())
+    measure_df['H'] = H
+    measure_df['Hbc'] = Hbc
+    measure_df['G'] = G
+    measure_df['J'] = J
 
     measure_df = measure_df[[compound_grouping, 'H', 'Hbc', 'G', 'J', 'identified_compounds_count']]
     measure_df = measure_df.rename(columns={'identified_compounds_count': 'GroupSize_Pathways'})
@@ -2,21 +2,281 @@ import multiprocessing
 import time
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numpy as np
 import pandas as pd
 
 from phytochempy.chemical_diversity_metrics import calculate_FAD_measures, get_pathway_based_diversity_measures
+from phytochempy.chemical_diversity_metrics.compound_distance_metrics import _bulk_tanimoto_u64, _fad_sum_direct, _fingerprints_for, \
+    _fps_to_u64_matrix
+from phytochempy.chemical_diversity_metrics.pathway_abundance_metrics import _diversity_indices, _pathway_indicator_matrix
+from phytochempy.compound_properties import get_npclassifier_result_columns_in_df
 
 
-def rarefy_diversity_for_group(df: pd.DataFrame, compound_grouping: str, group: str, target_size: int, metrics: list, method_to_calculate,
-                               iterations=1000,
-                               compound_id_col: str = None):
-    diversity_calc_means = {}
-    diversity_calc_stds = {}
-    group_df = df[df[compound_grouping] == group]
-    bootstrap_results = []
-    for _ in range(iterations):
-        # Randomly subsample to the target size
-        subsample = group_df.sample(target_size, replace=False)
+# Largest number of distinct compounds in a group for which all pairwise distances are held in memory (about 200MB)
+_MAX_DISTANCE_MATRIX_SIZE = 5000
+
+
+def _group_fingerprints(group_df: pd.DataFrame):
+    """
+    Pack the fingerprints of the distinct compounds in a group.
+
+    :param group_df: The compounds in the group.
+    :return: A tuple of the position of each row's compound in the fingerprint matrix and the packed fingerprint matrix. None if any
+    compound can't be fingerprinted.
+    """
+    if 'Standard_SMILES' not in group_df.columns:
+        return None
+    smiles_codes, unique_smiles = pd.factorize(group_df['Standard_SMILES'])
+    fps = _fingerprints_for(pd.Series(unique_smiles))
+    if (smiles_codes < 0).any() or any(fp is None for fp in fps):
+        return None
+    return smiles_codes, _fps_to_u64_matrix(fps)
+
+
+def _group_distance_matrix(fp_matrix: np.ndarray) -> np.ndarray:
+    """
+    Calculate the full symmetric matrix of Tanimoto distances between the rows of a packed fingerprint matrix.
+    """
+    n = len(fp_matrix)
+    distance_matrix = np.zeros((n, n))
+    distance_matrix[np.tril_indices(n, -1)] = _bulk_tanimoto_u64(fp_matrix)
+    distance_matrix += distance_matrix.T
+    return distance_matrix
+
+
+def _exact_fad_moments(group_df: pd.DataFrame, target_size: int, metrics: list):
+    """
+    Calculate the mean and standard deviation of FAD measures over all subsamples of the given size drawn without replacement, without
+    any sampling.
+
+    The FAD of a subsample is a sum of pairwise distances, so its moments follow from the probabilities that one pair, or two pairs
+    sharing one or no compounds, are all in the subsample. This is only possible when the group has no duplicated compounds, so that every
+    subsample has the same size.
+
+    :param group_df: The compounds in the group.
+    :param target_size: The size of the subsamples.
+    :param metrics: The FAD measures to return.
+    :return: A tuple of lists of the means and standard deviations of the metrics. None if the exact calculation isn't possible.
+    """
+    if not set(metrics).issubset(['FAD', 'MFAD', 'APWD', 'GroupSize_FAD']):
+        return None
+    n = len(group_df)
+    k = target_size
+    if k < 2 or k > n or n > _MAX_DISTANCE_MATRIX_SIZE:
+        return None
+    fingerprints = _group_fingerprints(group_df)
+    if fingerprints is None or len(fingerprints[1]) < n:
+        return None
+    distance_matrix = _group_distance_matrix(fingerprints[1])
+
+    # Probability that 2, 3 or 4 given compounds are all in the subsample
+    p2 = k * (k - 1) / (n * (n - 1))
+    p3 = 0.0 if k < 3 else p2 * (k - 2) / (n - 2)
+    p4 = 0.0 if k < 4 else p3 * (k - 3) / (n - 3)
+
+    row_sums = distance_matrix.sum(axis=1)
+    # Sum of distances over all pairs, sum of squared distances over all pairs, and sum of products of distances over ordered pairs of
+    # pairs which share one compound
+    total = row_sums.sum() / 2
+    total_squares = np.square(distance_matrix).sum() / 2
+    shared_products = np.square(row_sums).sum() - 2 * total_squares
+    disjoint_products = total ** 2 - total_squares - shared_products
+
+    mean_pair_sum = p2 * total
+    pair_sum_variance = p2 * total_squares + p3 * shared_products + p4 * disjoint_products - mean_pair_sum ** 2
+    pair_sum_std = np.sqrt(max(pair_sum_variance, 0.0))
+
+    # FAD counts each pair twice, and the other measures are FAD scaled by a constant
+    scales = {'FAD': 2, 'MFAD': 2 / k, 'APWD': 2 / (k ** 2 - k)}
+    means = [k if m == 'GroupSize_FAD' else scales[m] * mean_pair_sum for m in metrics]
+    stds = [0.0 if m == 'GroupSize_FAD' else scales[m] * pair_sum_std for m in metrics]
+    return means, stds
+
+
+def _fad_calculator(group_df: pd.DataFrame, metrics: list):
+    """
+    Prepare a calculation of FAD measures for subsamples of a group. Fingerprints are packed once for the whole group and, unless the group is
+    very large, the distances between all pairs of compounds in the group are computed once so each subsample just sums a submatrix.
+
+    :param group_df: The compounds in the group.
+    :param metrics: The FAD measures to return.
+    :return: A function taking an array of subsamples of row positions in group_df (one subsample per row) and returning a tuple of an
+    array of the values of the metrics for each subsample and a boolean array marking subsamples which should be left to
+    calculate_FAD_measures. None if the fingerprints can't be prepared for the group.
+    """
+    if not set(metrics).issubset(['FAD', 'MFAD', 'APWD', 'GroupSize_FAD']):
+        return None
+    fingerprints = _group_fingerprints(group_df)
+    if fingerprints is None:
+        return None
+    smiles_codes, fp_matrix = fingerprints
+    n = len(fp_matrix)
+
+    distance_matrix = _group_distance_matrix(fp_matrix) if n <= _MAX_DISTANCE_MATRIX_SIZE else None
+
+    def calculate(subsamples):
+        compounds = smiles_codes[subsamples]
+        N = np.empty(len(compounds), dtype=int)
+        FAD = np.empty(len(compounds))
+        for i, sample_compounds in enumerate(compounds):
+            # Duplicated compounds are removed, as in calculate_FAD_measures
+            sample_compounds = np.unique(sample_compounds)
+            N[i] = len(sample_compounds)
+            if distance_matrix is not None:
+                FAD[i] = distance_matrix[np.ix_(sample_compounds, sample_compounds)].sum()
+            else:
+                FAD[i] = _fad_sum_direct(fp_matrix[sample_compounds]) * 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = {'FAD': FAD, 'MFAD': FAD / N, 'APWD': FAD / (N ** 2 - N), 'GroupSize_FAD': N}
+        return np.column_stack([values[m] for m in metrics]).astype(float), N < 2
+
+    return calculate
+
+
+def _pathway_calculator(group_df: pd.DataFrame, metrics: list, compound_id_col: str, pathway_matrix: np.ndarray = None):
+    """
+    Prepare a calculation of pathway diversity measures for subsamples of a group, where pathways are one-hot encoded once for the whole group.
+
+    :param group_df: The compounds in the group.
+    :param metrics: The pathway diversity measures to return.
+    :param compound_id_col: The column used to determine compound uniqueness.
+    :param pathway_matrix: The one-hot encoded pathways of the rows in group_df, if already calculated.
+    :return: A function taking an array of subsamples of row positions in group_df (one subsample per row) and returning a tuple of an
+    array of the values of the metrics for each subsample (NaN where no compounds have pathway information) and a boolean array marking
+    subsamples which should be left to get_pathway_based_diversity_measures. None if the calculation can't be prepared for the group.
+    """
+    if not set(metrics).issubset(['H', 'Hbc', 'G', 'J', 'GroupSize_Pathways']):
+        return None
+    # Missing IDs are treated as a single compound, as in drop_duplicates
+    id_codes, _ = pd.factorize(group_df[compound_id_col], use_na_sentinel=False)
+    has_pathways = group_df['NPclassif_pathway_results'].notna().to_numpy()
+    if pathway_matrix is None:
+        pathway_matrix = _pathway_indicator_matrix(group_df)
+
+    def calculate(subsamples):
+        values = np.full((len(subsamples), len(metrics)), np.nan)
+        for i, idx in enumerate(subsamples):
+            # Keep the first record of each compound in the subsample, as in get_pathway_based_diversity_measures
+            _, first = np.unique(id_codes[idx], return_index=True)
+            kept = idx[first]
+            kept = kept[has_pathways[kept]]
+            if len(kept) == 0:
+                continue
+            counts = pathway_matrix[kept].sum(axis=0)
+            # Compounds with multiple pathways are counted once for each pathway, as in split_multiple_pathways_into_duplicate_rows
+            total = np.maximum(pathway_matrix[kept].sum(axis=1), 1).sum()
+            H, Hbc, G, J = _diversity_indices(counts[None, :], np.array([total]))
+            sample_values = {'H': H[0], 'Hbc': Hbc[0], 'G': G[0], 'J': J[0], 'GroupSize_Pathways': total}
+            values[i] = [sample_values[m] for m in metrics]
+        return values, np.zeros(len(subsamples), dtype=bool)
+
+    return calculate
+
+
+def _draw_subsamples(rng: np.random.Generator, n: int, target_size: int, iterations: int, shuffle: bool = True) -> np.ndarray:
+    """
+    Draw random subsamples without replacement of the positions 0..n-1, for all iterations at once.
+
+    :param rng: The random number generator to use.
+    :param n: The number of positions to sample from.
+    :param target_size: The size of each subsample.
+    :param iterations: The number of subsamples.
+    :param shuffle: Whether the positions within each subsample should be in random order.
+    :return: An integer array of shape [iterations, target_size], one subsample per row.
+    """
+    if target_size > n:
+        raise ValueError(f'Cannot take a sample of size {target_size} from a population of {n} without replacement')
+    subsamples = np.empty((iterations, target_size), dtype=np.intp)
+    if target_size == 0:
+        return subsamples
+    # Rank random keys for each iteration, in blocks so the keys stay a bounded size
+    block_size = max(1, (1 << 22) // n)
+    for start in range(0, iterations, block_size):
+        keys = rng.random((min(block_size, iterations - start), n))
+        subsamples[start:start + len(keys)] = np.argpartition(keys, target_size - 1, axis=1)[:, :target_size]
+    if shuffle:
+        subsamples = rng.permuted(subsamples, axis=1)
+    return subsamples
+
+
+def _hypergeometric_pathway_measures(group_df: pd.DataFrame, metrics: list, compound_id_col: str, target_size: int, iterations: int,
+                                     rng: np.random.Generator, pathway_matrix: np.ndarray = None):
+    """
+    Calculate pathway diversity measures for random subsamples of a group without drawing individual compounds.
+
+    When no compound is duplicated in the group, the measures for a subsample only depend on how many compounds are drawn with each
+    combination of pathways. These numbers follow a multivariate hypergeometric distribution, so are drawn for all iterations at once.
+
+    :param group_df: The compounds in the group.
+    :param metrics: The pathway diversity measures to return.
+    :param compound_id_col: The column used to determine compound uniqueness.
+    :param target_size: The size of each subsample.
+    :param iterations: The number of subsamples.
+    :param rng: The random number generator to use.
+    :param pathway_matrix: The one-hot encoded pathways of the rows in group_df, if already calculated.
+    :return: An array of shape [iterations, len(metrics)] of the values of the metrics for each subsample, NaN where no compounds have
+    pathway information. None if the group has duplicated compounds.
+    """
+    if not set(metrics).issubset(['H', 'Hbc', 'G', 'J', 'GroupSize_Pathways']):
+        return None
+    if group_df[compound_id_col].duplicated().any():
+        return None
+    if target_size > len(group_df):
+        raise ValueError(f'Cannot take a sample of size {target_size} from a population of {len(group_df)} without replacement')
+    if pathway_matrix is None:
+        pathway_matrix = _pathway_indicator_matrix(group_df)
+    has_pathways = group_df['NPclassif_pathway_results'].notna().to_numpy()
+
+    # Compounds without pathway information are dropped from the calculation, so form their own category which contributes nothing
+    categories, category_sizes = np.unique(np.column_stack([has_pathways, pathway_matrix]), axis=0, return_counts=True)
+    category_pathways = categories[:, 1:] * categories[:, :1]
+    # Compounds with multiple pathways are counted once for each pathway, as in split_multiple_pathways_into_duplicate_rows
+    category_totals = np.maximum(category_pathways.sum(axis=1), 1) * categories[:, 0]
+
+    draws = rng.multivariate_hypergeometric(category_sizes, target_size, size=iterations)
+    counts = draws @ category_pathways
+    totals = draws @ category_totals
+    with np.errstate(divide='ignore', invalid='ignore'):
+        H, Hbc, G, J = _diversity_indices(counts, totals)
+    values = {'H': H, 'Hbc': Hbc, 'G': G, 'J': J, 'GroupSize_Pathways': totals}
+    values = np.column_stack([values[m] for m in metrics]).astype(float)
+    values[totals == 0] = np.nan
+    return values
+
+
+def _subsampled_measures(group_df: pd.DataFrame, compound_grouping: str, target_size: int, metrics: list, method_to_calculate,
+                         iterations: int, compound_id_col: str, pathway_matrix: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """
+    Calculate diversity measures for random subsamples of a group.
+
+    :return: An array of shape [iterations, len(metrics)] of the values of the metrics for each subsample, NaN where a subsample gives no
+    result.
+    """
+    # For the package's own measures, precompute what is needed for the group once and work on row positions for all iterations
+    fast_calculation = None
+    # FAD measures don't depend on the order of the subsample, so sampled positions don't need shuffling.
+    # Otherwise the order is kept random, as which duplicate records are kept depends on it
+    shuffle = True
+    if method_to_calculate is calculate_FAD_measures and compound_id_col is None:
+        fast_calculation = _fad_calculator(group_df, metrics)
+        shuffle = False
+    elif method_to_calculate is get_pathway_based_diversity_measures and compound_id_col is not None:
+        fast_calculation = _pathway_calculator(group_df, metrics, compound_id_col, pathway_matrix=pathway_matrix)
+
+    # Randomly subsample to the target size, as row positions in the group
+    subsamples = _draw_subsamples(rng, len(group_df), target_size, iterations, shuffle=shuffle)
+
+    # One row of metric values per iteration, left as NaN where an iteration gives no result
+    if fast_calculation is not None:
+        bootstrap_results, needs_calculation = fast_calculation(subsamples)
+    else:
+        bootstrap_results = np.empty((iterations, len(metrics)))
+        needs_calculation = np.ones(iterations, dtype=bool)
+    bootstrap_results[needs_calculation] = np.nan
+
+    for i in np.flatnonzero(needs_calculation):
+        idx = subsamples[i]
+        subsample = group_df.iloc[idx]
 
         # Calculate pairwise distances for the subsample
         if compound_id_col is None:
@@ -24,60 +284,173 @@ def rarefy_diversity_for_group(df: pd.DataFrame, compound_grouping: str, group:
         else:
             distances = method_to_calculate(subsample, compound_grouping, compound_id_col)
 
-        if compound_id_col is None:
-            assert len(distances) == 1
-        else:
-            assert len(distances) <= 1
+        # Pathway measures may give no result for a subsample, whereas FAD measures always should (iloc raises otherwise)
+        if compound_id_col is None or len(distances) > 0:
+            bootstrap_results[i] = distances[metrics].iloc[0].to_numpy(dtype=float)
+    return bootstrap_results
 
-        bootstrap_results.append(distances)
-    bootstrap_df = pd.concat(bootstrap_results)
 
-    if compound_id_col is None:
-        assert len(bootstrap_df) == iterations
+def rarefy_diversity_for_group(df: pd.DataFrame, compound_grouping: str, group: str, target_size: int, metrics: list, method_to_calculate,
+                               iterations=1000,
+                               compound_id_col: str = None, seed=None, return_std: bool = True):
+    """
+    Calculate the mean and standard deviation of diversity measures over random subsamples of the given size from a group.
+
+    When FAD measures (FAD, MFAD, APWD) are calculated without a compound_id_col and no compound in the group is duplicated, every
+    subsample has the same size. The mean and standard deviation are then calculated exactly over all possible subsamples rather than
+    estimated from random ones. In this case iterations and seed have no effect, and the standard deviation is the exact population
+    standard deviation rather than a sample estimate from the iterations.
+
+    :param df: The compounds in all groups.
+    :param compound_grouping: The column giving the group of each compound.
+    :param group: The group to rarefy.
+    :param target_size: The size of each subsample.
+    :param metrics: The diversity measures to calculate.
+    :param method_to_calculate: The function calculating the diversity measures for a subsample.
+    :param iterations: The number of random subsamples.
+    :param compound_id_col: The column used to determine compound uniqueness, if needed by method_to_calculate.
+    :param seed: Seed for the random subsampling.
+    :param return_std: Whether to calculate standard deviations. If False, None is returned in their place.
+    :return: A tuple of dicts of the means and standard deviations of the measures, keyed by '<metric>_Rare', along with the group.
+    """
+    group_df = df[df[compound_grouping] == group]
+    return _rarefy_group_df(group_df, compound_grouping, group, target_size, metrics, method_to_calculate, iterations=iterations,
+                            compound_id_col=compound_id_col, seed=seed, return_std=return_std)
+
+
+def _rarefy_group_df(group_df: pd.DataFrame, compound_grouping: str, group: str, target_size: int, metrics: list, method_to_calculate,
+                     iterations=1000,
+                     compound_id_col: str = None, pathway_matrix: np.ndarray = None, seed=None, return_std: bool = True):
+    """
+    As rarefy_diversity_for_group, for data which has already been restricted to the given group. The one-hot encoded pathways of the
+    rows in group_df can be given as pathway_matrix if already calculated.
+    """
+    diversity_calc_means = {}
+    # When only means are needed, standard deviations aren't calculated and None is returned in their place
+    diversity_calc_stds = {} if return_std else None
+
+    # Where possible, FAD measures are calculated exactly over all possible subsamples rather than estimated from random ones
+    if method_to_calculate is calculate_FAD_measures and compound_id_col is None:
+        moments = _exact_fad_moments(group_df, target_size, metrics)
+        if moments is not None:
+            for m, mean, std in zip(metrics, *moments):
+                diversity_calc_means[f'{m}_Rare'] = mean
+                if return_std:
+                    diversity_calc_stds[f'{m}_Rare'] = std
+            diversity_calc_means[compound_grouping] = group
+            if return_std:
+                diversity_calc_stds[compound_grouping] = group
+            return diversity_calc_means, diversity_calc_stds
+
+    rng = np.random.default_rng(seed)
+    bootstrap_results = None
+    if method_to_calculate is get_pathway_based_diversity_measures and compound_id_col is not None:
+        bootstrap_results = _hypergeometric_pathway_measures(group_df, metrics, compound_id_col, target_size, iterations, rng,
+                                                             pathway_matrix=pathway_matrix)
+    if bootstrap_results is None:
+        bootstrap_results = _subsampled_measures(group_df, compound_grouping, target_size, metrics, method_to_calculate, iterations,
+                                                 compound_id_col, pathway_matrix, rng)
+    bootstrap_df = pd.DataFrame(bootstrap_results, columns=metrics)
 
     for m in metrics:
         mean_distance = bootstrap_df[m].mean()
 
         diversity_calc_means[f'{m}_Rare'] = mean_distance
-        diversity_calc_stds[f'{m}_Rare'] = bootstrap_df[m].std()
+        if return_std:
+            diversity_calc_stds[f'{m}_Rare'] = bootstrap_df[m].std()
     diversity_calc_means[compound_grouping] = group
-    diversity_calc_stds[compound_grouping] = group
+    if return_std:
+        diversity_calc_stds[compound_grouping] = group
     # Return the mean and standard deviation of diversity calcs over iterations
     return diversity_calc_means, diversity_calc_stds
 
+# The data being rarefied and its one-hot encoded pathways, set once in each worker process by _init_worker rather than being pickled with
+# every task
+_worker_df = None
+_worker_pathway_matrix = None
+
+
+def _init_worker(df: pd.DataFrame, pathway_matrix: np.ndarray):
+    global _worker_df, _worker_pathway_matrix
+    _worker_df = df
+    _worker_pathway_matrix = pathway_matrix
+
+
 def _process_group(args):
-    (df, compound_grouping, group, target_size, iterations, compound_id_col) = args
+    (compound_grouping, group, start, end, target_size, iterations, compound_id_col, group_seed) = args
+    fad_seed, pathway_seed = group_seed.spawn(2)
+    # The data is sorted by group, so the group's rows are a contiguous slice
+    rows = _worker_df.iloc[start:end]
     start_time = time.time()
     print(f'doing group: {group}')
 
-    fad_means, fad_stds = rarefy_diversity_for_group(df, compound_grouping, group, target_size, ['FAD', 'MFAD', 'APWD'], calculate_FAD_measures,
-                                                     iterations=iterations)
-    group_df = pd.DataFrame(fad_means, index=[group])
+    fad_means, _ = _rarefy_group_df(rows, compound_grouping, group, target_size, ['FAD', 'MFAD', 'APWD'], calculate_FAD_measures,
+                                    iterations=iterations, seed=fad_seed, return_std=False)
 
-    pathway_means, pathway_stds = rarefy_diversity_for_group(df, compound_grouping, group, target_size, ['H', 'Hbc', 'G', 'J'],
-                                                             get_pathway_based_diversity_measures,
-                                                             iterations=iterations, compound_id_col=compound_id_col)
-    pathway_group_df = pd.DataFrame(pathway_means, index=[group])
+    pathway_means, _ = _rarefy_group_df(rows, compound_grouping, group, target_size, ['H', 'Hbc', 'G', 'J'],
+                                        get_pathway_based_diversity_measures,
+                                        iterations=iterations, compound_id_col=compound_id_col,
+                                        pathway_matrix=_worker_pathway_matrix[start:end], seed=pathway_seed, return_std=False)
     print(f'group: {group} took {time.time() - start_time} seconds')
-    return (group_df, pathway_group_df)
+    return (fad_means, pathway_means)
 
 
-def compile_rarified_calculations(df: pd.DataFrame, compound_grouping: str, target_size: int, compound_id_col: str, iterations=1000):
+def compile_rarified_calculations(df: pd.DataFrame, compound_grouping: str, target_size: int, compound_id_col: str, iterations=1000,
+                                  seed=None):
+    """
+    Calculate rarefied FAD and pathway diversity measures for every group, averaged over random subsamples of the given size.
+
+    As in rarefy_diversity_for_group, FAD measures for groups without duplicated compounds are calculated exactly over all possible
+    subsamples, so don't depend on iterations or seed.
+
+    :param df: The compounds in all groups.
+    :param compound_grouping: The column giving the group of each compound.
+    :param target_size: The size of each subsample.
+    :param compound_id_col: The column used to determine compound uniqueness for pathway measures.
+    :param iterations: The number of random subsamples for each group.
+    :param seed: Seed for the random subsampling, so results are reproducible.
+    :return: A tuple of dataframes of the mean FAD measures and mean pathway measures for each group, indexed by group.
+    """
     fad_all_groups = []
     pathway_all_groups = []
-    groups = df[compound_grouping].unique()
+    # Only the columns used by the diversity measures are passed to the workers
+    needed_cols = [compound_grouping, 'Standard_SMILES', compound_id_col] + get_npclassifier_result_columns_in_df(df)
+    df = df[[c for c in dict.fromkeys(needed_cols) if c in df.columns]]
+
+    # Sort once by group so each group is a contiguous block of rows, found from offsets rather than a scan of the data per group
+    df = df.sort_values(compound_grouping, kind='stable').reset_index(drop=True)
+    codes, groups = pd.factorize(df[compound_grouping])
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(codes[codes >= 0], minlength=len(groups)))))
+    # Pathways are one-hot encoded once for all the data, rather than for each group
+    pathway_matrix = _pathway_indicator_matrix(df)
     num_cpus = max(multiprocessing.cpu_count() - 1, 1)
+    # Independent random streams for each group, so results are reproducible for a given seed whichever worker runs each group
+    group_seeds = np.random.SeedSequence(seed).spawn(len(groups))
     args = [
-        (df, compound_grouping, group, target_size, iterations, compound_id_col)
-        for group in groups
+        (compound_grouping, group, offsets[i], offsets[i + 1], target_size, iterations, compound_id_col, group_seeds[i])
+        for i, group in enumerate(groups)
     ]
 
-    with ProcessPoolExecutor(max_workers=num_cpus) as executor:
-        futures = [executor.submit(_process_group, a) for a in args]
-        for future in as_completed(futures):
-            group_df, pathway_group_df = future.result()
-            fad_all_groups.append(group_df)
-            pathway_all_groups.append(pathway_group_df)
-    fad_all_groups = pd.concat(fad_all_groups)
-    pathway_all_groups = pd.concat(pathway_all_groups)
+    # There's no use in more workers than groups, and with a single worker the groups are just run in this process
+    num_workers = min(num_cpus, len(groups))
+    if num_workers <= 1:
+        _init_worker(df, pathway_matrix)
+        try:
+            for a in args:
+                fad_means, pathway_means = _process_group(a)
+                fad_all_groups.append(fad_means)
+                pathway_all_groups.append(pathway_means)
+        finally:
+            _init_worker(None, None)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                                 initargs=(df, pathway_matrix)) as executor:
+            futures = [executor.submit(_process_group, a) for a in args]
+            for future in as_completed(futures):
+                fad_means, pathway_means = future.result()
+                fad_all_groups.append(fad_means)
+                pathway_all_groups.append(pathway_means)
+    # Each group's results are a dict of values, so build each output once, indexed by group as before
+    fad_all_groups = pd.DataFrame(fad_all_groups, index=[r[compound_grouping] for r in fad_all_groups])
+    pathway_all_groups = pd.DataFrame(pathway_all_groups, index=[r[compound_grouping] for r in pathway_all_groups])
     return fad_all_groups, pathway_all_groups
@@ -1,3 +1,4 @@
+import itertools
 import os
 import unittest
 from operator import index
@@ -31,6 +32,17 @@ class MyTestCase(unittest.TestCase):
 
         print(AFADS)
 
+    def test_exact_fad_moments(self):
+        # With no duplicated compounds, FAD measures are given exactly, so should match those over every possible subsample
+        group_df = self.df[self.df['Groups'] == 'A']
+        rarified_A = rarefy_diversity_for_group(self.df, 'Groups', 'A', 2, ['FAD', 'MFAD', 'APWD'], calculate_FAD_measures)
+
+        all_subsamples = pd.concat([calculate_FAD_measures(group_df.iloc[list(idx)], 'Groups') for idx in
+                                    itertools.combinations(range(len(group_df)), 2)])
+        for m in ['FAD', 'MFAD', 'APWD']:
+            self.assertAlmostEqual(rarified_A[0][f'{m}_Rare'], all_subsamples[m].mean())
+            self.assertAlmostEqual(rarified_A[1][f'{m}_Rare'], all_subsamples[m].std(ddof=0))
+
     def test_pways(self):
 
         rarified_A = rarefy_diversity_for_group(self.df, 'Groups', 'A', 3, ['H', 'Hbc', 'G', 'J'], get_pathway_based_diversity_measures,
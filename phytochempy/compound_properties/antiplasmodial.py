@@ -5,7 +5,7 @@ import numpy as np
 from pkg_resources import resource_filename
 from tqdm import tqdm
 
-from phytochempy.compound_properties import simplify_inchi_key, sanitize_filename
+from phytochempy.compound_properties import simplify_inchi_key_series, sanitize_filename
 
 _input_path = resource_filename(__name__, 'inputs')
 chembl_apm_assay_info_csv = os.path.join(_input_path, 'chembl_apm_assay_info.csv')
@@ -86,7 +86,7 @@ def update_compound_info_from_chembl_apm_assays(pchembl_active_threshold: float
     df = pd.DataFrame(compound_data).drop_duplicates(keep='first').reset_index(drop=True)
 
     # Add some more info
-    df['InChIKey_simp'] = df['InChIKey'].apply(simplify_inchi_key)
+    df['InChIKey_simp'] = simplify_inchi_key_series(df['InChIKey'])
     df['assay_ic50_from_pchembl'] = df['assay_pchembl_value'].apply(convert_chembl_assay_value_to_ic50)
     df['mean_ic50'] = df.groupby([compound_id_col])[
         'assay_ic50_from_pchembl'].transform('mean')
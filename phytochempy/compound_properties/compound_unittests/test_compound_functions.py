@@ -4,8 +4,10 @@ import unittest
 import numpy as np
 import pandas as pd
 
-from phytochempy.compound_properties import resolve_cas_to_smiles, simplify_inchi_key, resolve_cas_to_inchikey, get_smiles_and_inchi_from_cas_ids, \
-    add_CAS_ID_translations_to_df, fill_match_ids, standardise_smiles_to_MAIP_smiles, standardise_SMILES
+from phytochempy.compound_properties import resolve_cas_to_smiles, simplify_inchi_key, simplify_inchi_key_series, resolve_cas_to_inchikey, \
+    sanitize_filename, get_smiles_and_inchi_from_cas_ids, \
+    add_CAS_ID_translations_to_df, fill_match_ids, standardise_smiles_to_MAIP_smiles, standardise_SMILES, filter_rows_containing_compound_keyword, \
+    standardise_SMILES_batch
 
 
 class CASresolve(unittest.TestCase):
@@ -78,6 +80,21 @@ class Testkeys(unittest.TestCase):
         if result is not None:
             raise ValueError
 
+    def test_simplify_inchi_key_series(self):
+        input_data = pd.Series(["INCHI_KEY_SAMPLE_STRING", "INCHI_KEY", "", None, np.nan])
+        result = simplify_inchi_key_series(input_data)
+        pd.testing.assert_series_equal(result, input_data.apply(simplify_inchi_key))
+
+        input_data = pd.Series([np.nan, np.nan])
+        pd.testing.assert_series_equal(simplify_inchi_key_series(input_data), input_data)
+
+
+class TestSanitizeFilename(unittest.TestCase):
+    def test_sanitize_filename(self):
+        self.assertEqual(sanitize_filename(' Fatty acids/Polyketides: <x>? '), 'Fatty_acidsPolyketides_x')
+        self.assertEqual(sanitize_filename(' a b ', replace_spaces=False), 'a b')
+        self.assertTrue(np.isnan(sanitize_filename(np.nan)))
+
 
 class TestFillIds(unittest.TestCase):
     def setUp(self):
@@ -109,6 +126,19 @@ class TestFillIds(unittest.TestCase):
         df_empty = pd.DataFrame(columns=['SMILES', 'InChIKey', 'CAS ID'])
         actual_df = fill_match_ids(df=df_empty, given_col='CAS ID')
         pd.testing.assert_frame_equal(actual_df, df_empty)
+
+
+class TestKeywordFilter(unittest.TestCase):
+    def test_filter_rows_containing_compound_keyword(self):
+        df = pd.DataFrame({'name': ['Quercetin', 'kaempferol', np.nan, '', 'x', 3],
+                           'other_name': [np.nan, 'QUERCETIN glucoside', '', np.nan, 'y', np.nan],
+                           'id': [0, 1, 2, 3, 4, 5]})
+        filtered_df, negative_filtered_df, nan_df = filter_rows_containing_compound_keyword(df, ['name', 'other_name'], 'quercetin')
+        self.assertEqual(filtered_df['id'].tolist(), [0, 1])
+        self.assertEqual(negative_filtered_df['id'].tolist(), [4, 5])
+        self.assertEqual(nan_df['id'].tolist(), [2, 3])
+
+
 class TestStandardiseSmiles(unittest.TestCase):
     def test_standardise_smiles_valid(self):
         self.assertEqual(standardise_smiles_to_MAIP_smiles('CO'), 'CO')
@@ -119,6 +149,10 @@ class TestStandardiseSmiles(unittest.TestCase):
         self.assertEqual(standardise_smiles_to_MAIP_smiles('NotaSMILES'), None)
         self.assertEqual(standardise_smiles_to_MAIP_smiles(None), None)
 
+    def test_standardise_smiles_with_suffix(self):
+        # Only the first token is parsed, so CXSMILES extensions are ignored
+        self.assertEqual(standardise_smiles_to_MAIP_smiles('C[C@H](O)F |&1:1|'), 'C[C@H](O)F')
+
 class TestrdkitStandardiseSmiles(unittest.TestCase):
     def test_standardise_smiles_valid(self):
         self.assertEqual(standardise_SMILES('CO'), 'CO')
@@ -128,5 +162,17 @@ class TestrdkitStandardiseSmiles(unittest.TestCase):
         self.assertEqual(standardise_SMILES('Not a SMILES'), None)
         self.assertEqual(standardise_SMILES('NotaSMILES'), None)
         self.assertEqual(standardise_SMILES(None), None)
+
+    def test_standardise_smiles_with_suffix(self):
+        # Only the first token is parsed, so names and CXSMILES extensions after the SMILES are ignored
+        self.assertEqual(standardise_SMILES('CCO ethanol'), 'CCO')
+        self.assertEqual(standardise_SMILES('O=C(O)c1ccccc1 Benzoic acid'), 'O=C(O)c1ccccc1')
+        self.assertEqual(standardise_SMILES('C[C@H](O)F |&1:1|'), 'C[C@H](O)F')
+
+    def test_standardise_smiles_batch(self):
+        smiles = ['CO', "[Na]OC(=O)Cc1ccc(C[NH3+])cc1.c1nnn[n-]1.O", 'NotaSMILES', None, np.nan, 'CO']
+        self.assertEqual(standardise_SMILES_batch(smiles), [standardise_SMILES(s) for s in smiles])
+
+
 if __name__ == '__main__':
     unittest.main()
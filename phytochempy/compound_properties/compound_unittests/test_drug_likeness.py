@@ -0,0 +1,39 @@
+import unittest
+
+import pandas as pd
+
+from phytochempy.compound_properties import get_bioavailability_rules, add_bioavailability_rules_to_df
+
+
+class BioavailabilityRules(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({'SMILES': ['CC(=O)Oc1ccccc1C(=O)O', 'CCCCCCCCCCCCCCCCCCCCCCCCCCCCC(=O)O', 'c1ccccc1' * 8, 'notasmiles', None]})
+
+    def test_rules(self):
+        result = get_bioavailability_rules(self.df, 'SMILES').set_index('SMILES')
+
+        # Aspirin passes both
+        self.assertEqual(result.loc['CC(=O)Oc1ccccc1C(=O)O', 'lipinski_pass'], 1)
+        self.assertEqual(result.loc['CC(=O)Oc1ccccc1C(=O)O', 'veber_pass'], 1)
+        # Long chain acid only fails on logP and rotatable bonds
+        self.assertEqual(result.loc['CCCCCCCCCCCCCCCCCCCCCCCCCCCCC(=O)O', 'lipinski_pass'], 1)
+        self.assertEqual(result.loc['CCCCCCCCCCCCCCCCCCCCCCCCCCCCC(=O)O', 'veber_pass'], 0)
+        # Polyphenyl fails on mw and logP
+        self.assertEqual(result.loc['c1ccccc1' * 8, 'lipinski_pass'], 0)
+        self.assertEqual(result.loc['c1ccccc1' * 8, 'veber_pass'], 1)
+
+    def test_unparsed_smiles(self):
+        result = get_bioavailability_rules(self.df, 'SMILES').set_index('SMILES')
+        self.assertTrue(pd.isna(result.loc['notasmiles', 'lipinski_pass']))
+        self.assertTrue(pd.isna(result.loc['notasmiles', 'veber_pass']))
+        self.assertEqual(result['lipinski_pass'].dtype, 'Int8')
+
+    def test_add_to_df(self):
+        result = add_bioavailability_rules_to_df(self.df, 'SMILES')
+        self.assertEqual(len(result), len(self.df))
+        self.assertEqual(result['SMILES'].tolist(), self.df['SMILES'].tolist())
+        self.assertTrue(pd.isna(result['lipinski_pass'].iloc[-1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import os.path
+import tempfile
 import unittest
 
 import numpy as np
@@ -10,48 +11,49 @@ from phytochempy.compound_properties import npclassify_smiles, get_npclassif_cla
 
 class TestNPClassifierMethods(unittest.TestCase):
 
-    def setUp(self):
-        self.smiles_list = {'CC(=C)CCO': {'NPclassif_class_results': 'Acyclic monoterpenoids:Fatty alcohols',
-                                          'NPclassif_class_results_0': 'Acyclic monoterpenoids',
-                                          'NPclassif_class_results_1': 'Fatty alcohols',
-                                          'NPclassif_isglycoside': False,
-                                          'NPclassif_pathway_results': 'Fatty acids:Terpenoids',
-                                          'NPclassif_pathway_results_0': 'Fatty acids',
-                                          'NPclassif_pathway_results_1': 'Terpenoids',
-                                          'NPclassif_superclass_results': 'Fatty acyls:Monoterpenoids',
-                                          'NPclassif_superclass_results_0': 'Fatty acyls',
-                                          'NPclassif_superclass_results_1': 'Monoterpenoids',
-                                          'npSMILES': 'CC(=C)CCO'},
-                            'CCCCCCCCCCCCCCCC(=O)O': {'NPclassif_class_results': 'Branched fatty acids:Unsaturated fatty acids',
-                                                      'NPclassif_class_results_0': 'Branched fatty acids',
-                                                      'NPclassif_class_results_1': 'Unsaturated fatty acids',
-                                                      'NPclassif_isglycoside': False,
-                                                      'NPclassif_pathway_results': 'Fatty acids',
-                                                      'NPclassif_pathway_results_0': 'Fatty acids',
-                                                      'NPclassif_superclass_results': 'Fatty Acids and Conjugates',
-                                                      'NPclassif_superclass_results_0': 'Fatty Acids and Conjugates',
-                                                      'npSMILES': 'CCCCCCCCCCCCCCCC(=O)O'},
-                            "CC(=O)OC1=CC=CC=C1C(=O)O": {'npSMILES': 'CC(=O)OC1=CC=CC=C1C(=O)O',
-                                                         'NPclassif_class_results': 'Simple phenolic acids',
-                                                         'NPclassif_class_results_0': 'Simple phenolic acids',
-                                                         'NPclassif_isglycoside': False,
-                                                         'NPclassif_pathway_results': 'Shikimates and Phenylpropanoids',
-                                                         'NPclassif_pathway_results_0': 'Shikimates and Phenylpropanoids',
-                                                         'NPclassif_superclass_results': 'Phenolic acids (C6-C1)',
-                                                         'NPclassif_superclass_results_0': 'Phenolic acids (C6-C1)'},
-                            "C1=CC=CC=C1": {'npSMILES': 'C1=CC=CC=C1',
-                                            'NPclassif_class_results': np.nan, 'NPclassif_isglycoside': False,
-                                            'NPclassif_pathway_results': 'Shikimates and Phenylpropanoids',
-                                            'NPclassif_pathway_results_0': 'Shikimates and Phenylpropanoids',
-                                            'NPclassif_superclass_results': np.nan},
-                            "C1CCCCC1": {'npSMILES': 'C1CCCCC1',
-                                         'NPclassif_class_results': 'Lactones',
-                                         'NPclassif_class_results_0': 'Lactones',
+    @classmethod
+    def setUpClass(cls):
+        cls.smiles_list = {'CC(=C)CCO': {'NPclassif_class_results': 'Acyclic monoterpenoids:Fatty alcohols',
+                                         'NPclassif_class_results_0': 'Acyclic monoterpenoids',
+                                         'NPclassif_class_results_1': 'Fatty alcohols',
                                          'NPclassif_isglycoside': False,
-                                         'NPclassif_pathway_results': 'Fatty acids',
+                                         'NPclassif_pathway_results': 'Fatty acids:Terpenoids',
                                          'NPclassif_pathway_results_0': 'Fatty acids',
-                                         'NPclassif_superclass_results': 'Fatty esters',
-                                         'NPclassif_superclass_results_0': 'Fatty esters'}}
+                                         'NPclassif_pathway_results_1': 'Terpenoids',
+                                         'NPclassif_superclass_results': 'Fatty acyls:Monoterpenoids',
+                                         'NPclassif_superclass_results_0': 'Fatty acyls',
+                                         'NPclassif_superclass_results_1': 'Monoterpenoids',
+                                         'npSMILES': 'CC(=C)CCO'},
+                           'CCCCCCCCCCCCCCCC(=O)O': {'NPclassif_class_results': 'Branched fatty acids:Unsaturated fatty acids',
+                                                     'NPclassif_class_results_0': 'Branched fatty acids',
+                                                     'NPclassif_class_results_1': 'Unsaturated fatty acids',
+                                                     'NPclassif_isglycoside': False,
+                                                     'NPclassif_pathway_results': 'Fatty acids',
+                                                     'NPclassif_pathway_results_0': 'Fatty acids',
+                                                     'NPclassif_superclass_results': 'Fatty Acids and Conjugates',
+                                                     'NPclassif_superclass_results_0': 'Fatty Acids and Conjugates',
+                                                     'npSMILES': 'CCCCCCCCCCCCCCCC(=O)O'},
+                           "CC(=O)OC1=CC=CC=C1C(=O)O": {'npSMILES': 'CC(=O)OC1=CC=CC=C1C(=O)O',
+                                                        'NPclassif_class_results': 'Simple phenolic acids',
+                                                        'NPclassif_class_results_0': 'Simple phenolic acids',
+                                                        'NPclassif_isglycoside': False,
+                                                        'NPclassif_pathway_results': 'Shikimates and Phenylpropanoids',
+                                                        'NPclassif_pathway_results_0': 'Shikimates and Phenylpropanoids',
+                                                        'NPclassif_superclass_results': 'Phenolic acids (C6-C1)',
+                                                        'NPclassif_superclass_results_0': 'Phenolic acids (C6-C1)'},
+                           "C1=CC=CC=C1": {'npSMILES': 'C1=CC=CC=C1',
+                                           'NPclassif_class_results': np.nan, 'NPclassif_isglycoside': False,
+                                           'NPclassif_pathway_results': 'Shikimates and Phenylpropanoids',
+                                           'NPclassif_pathway_results_0': 'Shikimates and Phenylpropanoids',
+                                           'NPclassif_superclass_results': np.nan},
+                           "C1CCCCC1": {'npSMILES': 'C1CCCCC1',
+                                        'NPclassif_class_results': 'Lactones',
+                                        'NPclassif_class_results_0': 'Lactones',
+                                        'NPclassif_isglycoside': False,
+                                        'NPclassif_pathway_results': 'Fatty acids',
+                                        'NPclassif_pathway_results_0': 'Fatty acids',
+                                        'NPclassif_superclass_results': 'Fatty esters',
+                                        'NPclassif_superclass_results_0': 'Fatty esters'}}
 
     def test_npclassify_smiles(self):
         # Classify all SMILES strings in the list
@@ -94,6 +96,19 @@ class TestNPClassifierMethods(unittest.TestCase):
 
         pd.testing.assert_frame_equal(df, result)
 
+    def test_reading_manual_data_with_different_numbers_of_classes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manual_file = os.path.join(tmpdir, 'npclassifierinfo_manual_test.tsv')
+            pd.DataFrame({'smiles': ['CC', 'CCC'], 'class_results': ['a:b', 'c'], 'superclass_results': ['s', 's:t:u'],
+                          'pathway_results': ['Alkaloids', 'Terpenoids'], 'isglycoside': [False, False]}).to_csv(manual_file, sep='\t',
+                                                                                                                   index=False)
+            result = read_manual_npclassifier_input(manual_file)
+        self.assertEqual(result['NPclassif_class_results_1'].tolist()[0], 'b')
+        self.assertTrue(np.isnan(result['NPclassif_class_results_1'].tolist()[1]))
+        self.assertEqual(result['NPclassif_superclass_results_2'].tolist()[1], 'u')
+        self.assertTrue(np.isnan(result['NPclassif_superclass_results_1'].tolist()[0]))
+        self.assertTrue(np.isnan(result['NPclassif_superclass_results_2'].tolist()[0]))
+
     def test_reading_manual_data(self):
         result = read_manual_npclassifier_input(os.path.join('test_inputs', 'manual_test_results.tsv'))
         correct = pd.read_csv(os.path.join('test_inputs', 'test_manual_input_correct.csv'))
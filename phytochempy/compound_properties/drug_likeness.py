@@ -1,5 +1,48 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
 import pandas as pd
 
+# Below this many molecules, the cost of starting worker processes outweighs the gain from calculating descriptors in parallel
+_PARALLEL_DESCRIPTOR_THRESHOLD = 20000
+
+
+@lru_cache(maxsize=4096)
+def _mol_from_smiles(smiles: str):
+    """
+    Parse a SMILES string to an RDKit molecule. A small number of recent results are cached so compounds passed through repeated
+    calculations in the same process aren't parsed again, without keeping many molecules in memory.
+
+    :param smiles: The SMILES string.
+    :return: The molecule, or None if the SMILES could not be parsed.
+    """
+    from rdkit import Chem
+
+    return Chem.MolFromSmiles(smiles) if smiles else None
+
+
+def _bioavailability_descriptors(smiles: list) -> np.ndarray:
+    """
+    Calculate the descriptors used in bioavailability rules for each SMILES string, in a single pass over the molecules.
+
+    :param smiles: The SMILES strings.
+    :return: An array of shape [len(smiles), 6] giving the molecular weight, logP, number of hydrogen bond donors, number of hydrogen bond
+    acceptors, number of rotatable bonds and polar surface area of each molecule. Rows are NaN where a SMILES string couldn't be parsed.
+    """
+    from rdkit.Chem import rdMolDescriptors
+    from rdkit.Chem.Descriptors import MolWt
+
+    properties = np.full((len(smiles), 6), np.nan)
+    for i, s in enumerate(smiles):
+        m = _mol_from_smiles(s)
+        if m is not None:
+            # The rdMolDescriptors functions are called directly, rather than through the Crippen, Lipinski and MolSurf wrappers
+            properties[i] = (MolWt(m), rdMolDescriptors.CalcCrippenDescriptors(m)[0], rdMolDescriptors.CalcNumHBD(m),
+                             rdMolDescriptors.CalcNumHBA(m), rdMolDescriptors.CalcNumRotatableBonds(m), rdMolDescriptors.CalcTPSA(m))
+    return properties
+
 
 def get_bioavailability_rules(in_df: pd.DataFrame, smiles_col: str) -> pd.DataFrame:
     """
@@ -12,61 +55,49 @@ def get_bioavailability_rules(in_df: pd.DataFrame, smiles_col: str) -> pd.DataFr
     The input `in_df` should be a pandas DataFrame with at least one column containing the SMILES strings. Any rows in `in_df` with empty or NaN values in the `smiles_col` will be excluded
     * from the computation.
 
-    The method first drops duplicate rows based on the `smiles_col`. Then, it adds a new column 'rdkit_mol' to the DataFrame using RDKit's `PandasTools.AddMoleculeColumnToFrame` function
-    *.
+    The method first drops duplicate rows based on the `smiles_col`. Then, each SMILES string is parsed to an RDKit molecule. For large datasets, this and the
+    * following descriptor calculations are split across worker processes.
 
     Next, the method calculates various properties for each molecule in the DataFrame: molecular weight (`mw`), octanol-water partition coefficient (`logP`), number of hydrogen bond accept
-    *ors (`HBA`), and number of hydrogen bond donors (`HBD`). These properties are computed using RDKit's built-in functions: `MolWt`, `MolLogP`, `NumHAcceptors`, and `NumHDonors`.
+    *ors (`HBA`), and number of hydrogen bond donors (`HBD`). These properties are computed using RDKit's built-in functions: `MolWt`, `CalcCrippenDescriptors`, `CalcNumHBA`, and `CalcNumHBD`.
 
     The method then applies Lipinski's rule of five to determine whether a molecule passes or fails the rule. Lipinski's rule of five states that a molecule is likely to have good oral bio
     *availability if it satisfies at least three of the following four criteria: molecular weight <= 500, hydrogen bond acceptors <= 10, hydrogen bond donors <= 5, and logP <= 5. The result
     * of this calculation is stored in a new column named 'lipinski_pass'.
 
-    Next, the method calculates the number of rotatable bonds (`rotatable_bonds`) and the polar surface area (`polar_surface_area`) for each molecule using RDKit's `NumRotatableBonds` and
-    * `TPSA` functions.
+    Next, the method calculates the number of rotatable bonds (`rotatable_bonds`) and the polar surface area (`polar_surface_area`) for each molecule using RDKit's `CalcNumRotatableBonds` and
+    * `CalcTPSA` functions.
 
     Finally, the method applies Veber's rule to determine whether a molecule passes or fails the rule. Veber's rule states that a molecule is likely to have good oral bioavailability if
     * it satisfies the following two criteria: number of rotatable bonds <= 10 and polar surface area <= 140. The result of this calculation is stored in a new column named 'veber_pass'.
 
     The method selects only the columns 'veber_pass', 'lipinski_pass', and `smiles_col` from the DataFrame and returns the resulting DataFrame.
     """
-    from rdkit.Chem import PandasTools
-    from rdkit.Chem.Crippen import MolLogP
-    from rdkit.Chem.Descriptors import MolWt
-    from rdkit.Chem.Lipinski import NumHAcceptors, NumHDonors, NumRotatableBonds
-    from rdkit.Chem.MolSurf import TPSA
-    df = in_df[~in_df[smiles_col].isna()].drop_duplicates(subset=smiles_col, keep='first')
-    PandasTools.AddMoleculeColumnToFrame(df, smiles_col, 'rdkit_mol')
-    df['mw'] = df['rdkit_mol'].apply(lambda x: MolWt(x) if x is not None else None)
-    df['logP'] = df['rdkit_mol'].apply(lambda x: MolLogP(x) if x is not None else None)
-    df['HBD'] = df['rdkit_mol'].apply(lambda x: NumHDonors(x) if x is not None else None)
-    df['HBA'] = df['rdkit_mol'].apply(lambda x: NumHAcceptors(x) if x is not None else None)
-
-    def lipinski_check(row):
-        if row['mw'] is not None:
-            conditions = [row['mw'] <= 500, row['HBA'] <= 10, row['HBD'] <= 5, row['logP'] <= 5]
-            if conditions.count(True) >= 3:
-                return 1
-            else:
-                return 0
-        else:
-            return None
-
-    df['lipinski_pass'] = df.apply(lambda x: lipinski_check(x), axis=1)
-
-    df['rotatable_bonds'] = df['rdkit_mol'].apply(lambda x: NumRotatableBonds(x) if x is not None else None)
-    df['polar_surface_area'] = df['rdkit_mol'].apply(lambda x: TPSA(x) if x is not None else None)
-
-    def veber_check(row):
-        if row['mw'] is not None:
-            if row['rotatable_bonds'] <= 10 and row['polar_surface_area'] <= 140:
-                return 1
-            else:
-                return 0
-        else:
-            return None
-
-    df['veber_pass'] = df.apply(lambda x: veber_check(x), axis=1)
+    # Only the SMILES are needed, so other columns aren't copied. Descriptors are calculated once for each unique SMILES
+    df = in_df[[smiles_col]].dropna(subset=[smiles_col]).drop_duplicates(subset=smiles_col, keep='first')
+    smiles = df[smiles_col].tolist()
+    num_cpus = max(multiprocessing.cpu_count() - 1, 1)
+    if len(smiles) >= _PARALLEL_DESCRIPTOR_THRESHOLD and num_cpus > 1:
+        # For large datasets, molecules are split into a chunk for each worker process.
+        # SMILES rather than rdkit molecules are sent to the workers as they are much cheaper to pickle
+        chunk_size = -(-len(smiles) // num_cpus)
+        chunks = [smiles[i:i + chunk_size] for i in range(0, len(smiles), chunk_size)]
+        with ProcessPoolExecutor(max_workers=num_cpus) as executor:
+            properties = np.concatenate(list(executor.map(_bioavailability_descriptors, chunks)))
+    else:
+        properties = _bioavailability_descriptors(smiles)
+    df = df.assign(mw=properties[:, 0], logP=properties[:, 1], HBD=properties[:, 2], HBA=properties[:, 3], rotatable_bonds=properties[:, 4],
+                   polar_surface_area=properties[:, 5])
+
+    # Rules are checked on whole columns at once. Molecules which couldn't be parsed have no properties, so the rules are left undefined.
+    # Outcomes are stored as nullable 8-bit integers rather than floats
+    unparsed = df['mw'].isna().to_numpy()
+    lipinski_conditions = ((df['mw'] <= 500).astype('int8') + (df['HBA'] <= 10).astype('int8') + (df['HBD'] <= 5).astype('int8') +
+                           (df['logP'] <= 5).astype('int8'))
+    df['lipinski_pass'] = pd.arrays.IntegerArray((lipinski_conditions >= 3).to_numpy(dtype='int8'), unparsed)
+
+    df['veber_pass'] = pd.arrays.IntegerArray(((df['rotatable_bonds'] <= 10) & (df['polar_surface_area'] <= 140)).to_numpy(dtype='int8'),
+                                              unparsed)
     df = df[['veber_pass', 'lipinski_pass', smiles_col]]
 
     return df
@@ -81,8 +112,11 @@ def add_bioavailability_rules_to_df(df: pd.DataFrame, smiles_col: str) -> pd.Dat
     :return: The DataFrame with the added bioavailability rules.
     """
     bio_av = get_bioavailability_rules(df, smiles_col)
-    bio_av = bio_av.dropna(subset=[smiles_col])
+    bio_av = bio_av.dropna(subset=[smiles_col]).set_index(smiles_col)
 
-    all_metabolites_with_info = pd.merge(df, bio_av, how='left', on=smiles_col)
+    # SMILES are unique in bio_av, so rules are looked up for each row rather than merging whole dataframes
+    all_metabolites_with_info = df.reset_index(drop=True)
+    for rule in ['veber_pass', 'lipinski_pass']:
+        all_metabolites_with_info[rule] = all_metabolites_with_info[smiles_col].map(bio_av[rule])
 
     return all_metabolites_with_info
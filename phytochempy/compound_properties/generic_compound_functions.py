@@ -1,21 +1,114 @@
+import io
+import multiprocessing
 import os
 import pathlib
 import re
+import threading
 import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from typing import List
 
 import cirpy
 import numpy as np
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 from rdkit import Chem
 from rdkit.Chem.MolStandardize import rdMolStandardize
 from standardiser import standardise
 from tqdm import tqdm
+from urllib3.util import Retry
 
 COMPOUND_NAME_COLUMN = 'example_compound_name'
 
+# CAS ID resolution is limited by waiting on web services, so IDs are resolved concurrently in threads.
+# Kept small so as not to put too much load on the services.
+_CAS_RESOLUTION_WORKERS = 8
+# How often (in number of resolved IDs) results are saved to the temporary output file
+_CAS_CACHE_SAVE_INTERVAL = 50
+# Timeout (in seconds) for connecting to and reading from web services
+_REQUEST_TIMEOUT = 60
+# Knapsack information page for a given CAS ID
+_KNAPSACK_CAS_URL = 'http://www.knapsackfamily.com/knapsack_core/information.php?sname=CAS_ID&word={cas_id}'
+# Maximum sustained rate of requests to Knapsack, shared between all threads
+_KNAPSACK_REQUESTS_PER_SECOND = 30
+# Below this many SMILES, the cost of starting worker processes outweighs the gain from standardising in parallel
+_PARALLEL_STANDARDISATION_THRESHOLD = 20000
+
+
+def _new_session() -> requests.Session:
+    """
+    Create a requests session which keeps connections to web services open between requests, and retries requests which fail due to
+    rate limiting or server errors (with exponential backoff).
+
+    :return: The session.
+    """
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Shared by all requests to web services, so connections are reused
+_SESSION = _new_session()
+
+
+class _RateLimiter:
+    """
+    Token bucket limiting how often requests are made to a web service. Bursts of up to `rate` requests are allowed, after which callers
+    wait so that the overall rate is at most `rate` requests per second. Safe to share between threads.
+
+    :param rate: The maximum number of requests per second.
+    """
+
+    def __init__(self, rate: float):
+        self._rate = rate
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until a request can be made.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._rate, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            if self._tokens < 1:
+                # Waiting while holding the lock means other threads queue behind this one
+                time.sleep((1 - self._tokens) / self._rate)
+                self._tokens = 1
+                self._last = time.monotonic()
+            self._tokens -= 1
+
+
+_KNAPSACK_RATE_LIMITER = _RateLimiter(_KNAPSACK_REQUESTS_PER_SECOND)
+
+# Characters which may appear in a SMILES string, so that obviously invalid strings (e.g. compound names) can be rejected without parsing
+_SMILES_CHARACTERS = re.compile(r'[A-Za-z0-9@+\-\[\]()=#$%/\\.:*~]+')
+# Translation table deleting characters which aren't allowed in filenames
+_ILLEGAL_FILENAME_CHARACTERS = str.maketrans('', '', '\\/*?:"<>|')
+
+
+def _could_be_smiles(smiles: str) -> bool:
+    """
+    Check whether a value could be parsed as SMILES, without parsing it. As rdkit only parses the first whitespace-delimited token, only
+    that token is checked, so that SMILES followed by a name or CXSMILES extensions are still accepted.
+
+    :param smiles: The value to check.
+    :return: False if the value is not a string or its first token contains characters which can't appear in SMILES.
+    """
+    if not isinstance(smiles, str):
+        return False
+    tokens = smiles.split(maxsplit=1)
+    # Empty strings are left for rdkit to handle, as before
+    return len(tokens) == 0 or _SMILES_CHARACTERS.fullmatch(tokens[0]) is not None
+
 
 def standardise_smiles_to_MAIP_smiles(smiles: str) -> str:
     '''
@@ -34,7 +127,14 @@ def standardise_smiles_to_MAIP_smiles(smiles: str) -> str:
     :param smiles:
     :return:
     '''
+    if not _could_be_smiles(smiles):
+        return None
+    return _standardise_smiles_to_MAIP_smiles(smiles)
+
 
+@lru_cache(maxsize=500_000)
+def _standardise_smiles_to_MAIP_smiles(smiles: str) -> str:
+    # Cached, as the same compounds are often standardised repeatedly e.g. when combining datasets
     try:
 
         parent = standardise.run(smiles)
@@ -53,19 +153,55 @@ def standardise_SMILES(smiles: str) -> str:
     :param smiles:
     :return:
     '''
+    if not _could_be_smiles(smiles):
+        return None
+    return _standardise_SMILES(smiles)
+
+
+@lru_cache(maxsize=500_000)
+def _standardise_SMILES(smiles: str) -> str:
+    # Cached as in _standardise_smiles_to_MAIP_smiles
+    # Molecules are sanitised when parsed, so aren't sanitised again
+    mol = Chem.MolFromSmiles(smiles, sanitize=True)
+    if mol is None:
+        return None
     try:
-        mol = Chem.MolFromSmiles(smiles, sanitize=True)
-        Chem.SanitizeMol(mol)
         parent_clean_mol = rdMolStandardize.FragmentParent(mol)
 
         return Chem.MolToSmiles(parent_clean_mol, isomericSmiles=True)
-    except:
+    except (ValueError, RuntimeError):
+        # rdkit sanitisation errors are subclasses of ValueError
         return None
 
 
+def _standardise_SMILES_list(smiles: List[str]) -> List[str]:
+    return [standardise_SMILES(s) for s in smiles]
+
+
+def standardise_SMILES_batch(smiles: List[str]) -> List[str]:
+    '''
+    As standardise_SMILES, for a whole list (e.g. a dataframe column) of SMILES. Each distinct SMILES is only standardised once, and for
+    large lists the work is split across worker processes.
+    :param smiles: The SMILES strings, which may contain missing values.
+    :return: The standardised SMILES, in the same order as the input.
+    '''
+    unique_smiles = list(dict.fromkeys(s for s in smiles if isinstance(s, str)))
+    num_cpus = max(multiprocessing.cpu_count() - 1, 1)
+    if len(unique_smiles) >= _PARALLEL_STANDARDISATION_THRESHOLD and num_cpus > 1:
+        chunk_size = -(-len(unique_smiles) // num_cpus)
+        chunks = [unique_smiles[i:i + chunk_size] for i in range(0, len(unique_smiles), chunk_size)]
+        with ProcessPoolExecutor(max_workers=num_cpus) as executor:
+            standardised = [out for chunk in executor.map(_standardise_SMILES_list, chunks) for out in chunk]
+    else:
+        standardised = _standardise_SMILES_list(unique_smiles)
+    standardised_lookup = dict(zip(unique_smiles, standardised))
+    return [standardised_lookup[s] if isinstance(s, str) else None for s in smiles]
+
+
+@lru_cache(maxsize=100_000)
 def resolve_cas_to_smiles(cas_id: str):
     """
-    Resolves a given CAS ID to its corresponding SMILES representation.
+    Resolves a given CAS ID to its corresponding SMILES representation. Results are cached, so repeated IDs are only looked up once.
 
     :param cas_id: A string representing the CAS ID.
     :return: A string representing the SMILES representation of the given CAS ID.
@@ -78,9 +214,10 @@ def resolve_cas_to_smiles(cas_id: str):
     return out
 
 
+@lru_cache(maxsize=100_000)
 def resolve_cas_to_inchikey(cas_id: str):
     """
-    Resolve a CAS ID to its corresponding InChIKey.
+    Resolve a CAS ID to its corresponding InChIKey. Results are cached, so repeated IDs are only looked up once.
 
     :param cas_id: The CAS ID to resolve.
     :return: The resolved InChIKey or np.nan if not found.
@@ -94,6 +231,22 @@ def resolve_cas_to_inchikey(cas_id: str):
     return out
 
 
+def _resolve_cas_id(cas_id: str) -> dict:
+    """
+    Resolve a CAS ID to SMILES and InChIKey, first using Knapsack and then falling back to CIR (via cirpy) for any not found.
+
+    :param cas_id: The CAS ID to resolve.
+    :return: A dictionary of the CAS ID, SMILES and InChIKey.
+    """
+    inch_result, smiles_result = get_compound_ids_from_CAS_ID_from_knapsack(cas_id)
+    if smiles_result is None:
+        smiles_result = resolve_cas_to_smiles(cas_id)
+    # If neither Knapsack nor CIR could give a structure for the ID, CIR won't give an InChIKey either, so the second request is skipped
+    if inch_result is None and smiles_result is not None:
+        inch_result = resolve_cas_to_inchikey(cas_id)
+    return {'CAS ID': cas_id, 'SMILES': smiles_result, 'InChIKey': inch_result}
+
+
 def get_smiles_and_inchi_from_cas_ids(cas_ids: List[str], tempout_dir: str = None):
     """
     :param cas_ids: A list of CAS IDs for which SMILES and InChIKey are to be retrieved.
@@ -118,22 +271,20 @@ def get_smiles_and_inchi_from_cas_ids(cas_ids: List[str], tempout_dir: str = Non
 
             already_known_cas_ids = set(existing_df['CAS ID'].tolist())
             unique_cas_ids = [s for s in unique_cas_ids if s not in already_known_cas_ids]
-    cache_csv = os.path.join(tempout_dir, temp_file_tag + str(uuid.uuid4()) + '.csv')
-    out_df = pd.DataFrame()
-
-    for c_id in tqdm(unique_cas_ids, desc='Resolving CAS IDs..'):
-        inch_result, smiles_result = get_compound_ids_from_CAS_ID_from_knapsack(c_id)
-        if smiles_result is None:
-            smiles_result = resolve_cas_to_smiles(c_id)
-        if inch_result is None:
-            inch_result = resolve_cas_to_inchikey(c_id)
-        result = {'CAS ID': c_id, 'SMILES': smiles_result, 'InChIKey': inch_result}
-        ent_df = pd.DataFrame(result, index=[0])
-        out_df = pd.concat([out_df, ent_df])
-
-        if tempout_dir is not None:
-            if len(out_df.index) > 0:
-                out_df.to_csv(cache_csv)
+    cache_csv = os.path.join(tempout_dir, temp_file_tag + str(uuid.uuid4()) + '.csv') if tempout_dir is not None else None
+
+    results = []
+    # Number of results already written to the cache file. Only new results are appended, rather than rewriting the file each time
+    num_saved = 0
+    with ThreadPoolExecutor(max_workers=_CAS_RESOLUTION_WORKERS) as executor:
+        futures = [executor.submit(_resolve_cas_id, c_id) for c_id in unique_cas_ids]
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Resolving CAS IDs..'):
+            results.append(future.result())
+            if cache_csv is not None and (len(results) % _CAS_CACHE_SAVE_INTERVAL == 0 or len(results) == len(futures)):
+                new_results = pd.DataFrame(results[num_saved:], columns=['CAS ID', 'SMILES', 'InChIKey'], index=range(num_saved, len(results)))
+                new_results.to_csv(cache_csv, mode='a', header=num_saved == 0)
+                num_saved = len(results)
+    out_df = pd.DataFrame(results, columns=['CAS ID', 'SMILES', 'InChIKey'])
     if existing_df is not None:
         out_df = pd.concat([out_df, existing_df])
     out_df = out_df.sort_values(by='CAS ID')
@@ -151,10 +302,14 @@ def add_CAS_ID_translations_to_df(df: pd.DataFrame, cas_id_col: str, tempout_dir
     This method takes a DataFrame and adds CAS ID translations to it. The translations are obtained by calling the 'get_smiles_and_inchi_from_cas_ids' method.
 
     """
-    pathlib.Path(tempout_dir).mkdir(parents=True, exist_ok=True)
-    _info = get_smiles_and_inchi_from_cas_ids(df[cas_id_col].dropna(), tempout_dir)
+    if tempout_dir is not None:
+        pathlib.Path(tempout_dir).mkdir(parents=True, exist_ok=True)
+    # Each CAS ID is only resolved once, however many rows it appears in
+    unique_cas_ids = df[cas_id_col].dropna().drop_duplicates().tolist()
+    _info = get_smiles_and_inchi_from_cas_ids(unique_cas_ids, tempout_dir)
 
-    _info[[cas_id_col, 'SMILES', 'InChIKey']].drop_duplicates(keep='first').dropna(subset=cas_id_col)
+    # Keep a single translation for each ID, so merging doesn't duplicate rows in df
+    _info = _info[[cas_id_col, 'SMILES', 'InChIKey']].dropna(subset=cas_id_col).drop_duplicates(subset=cas_id_col, keep='first')
 
     all_metabolites_with_info = pd.merge(df, _info, how='left', on=cas_id_col)
 
@@ -165,15 +320,30 @@ def simplify_inchi_key(inch: str):
     """
     :param inch: The original InChIKey string.
     :return: The simplified InChIKey string, using only the first 14 characters of the original InChIKey.
+
+    For whole columns of InChIKeys, use simplify_inchi_key_series instead.
     """
     # Using the connectivity layer of the InChIKey, i.e. the first 14 characters, to simplify.
     # As in e.g. https://www.sciencedirect.com/science/article/abs/pii/S2352007822002372 https://pubs.acs.org/doi/abs/10.1007/s13361-016-1589-4
-    if inch == inch and inch is not None:
+    if pd.notna(inch):
         return inch[:14]
     else:
         return inch
 
 
+def simplify_inchi_key_series(inchikeys: pd.Series) -> pd.Series:
+    """
+    As simplify_inchi_key, applied to a whole series of InChIKeys at once.
+
+    :param inchikeys: A series of InChIKey strings, which may contain missing values.
+    :return: The simplified InChIKeys, with missing values left as they are.
+    """
+    if inchikeys.isna().all():
+        # The .str accessor isn't available for series without any strings
+        return inchikeys.copy()
+    return inchikeys.str.slice(0, 14)
+
+
 def sanitize_filename(pathway: str, replace_spaces: bool = True) -> str:
     """
     Sanitize given pathway/compound names as they are currently not very nice for handling filenames and/or importing exporting in R etc..
@@ -185,7 +355,7 @@ def sanitize_filename(pathway: str, replace_spaces: bool = True) -> str:
     Returns:
         str: The sanitized filename.
     """
-    if pathway == pathway:
+    if pd.notna(pathway):
         # Remove leading and trailing whitespace
         pathway = pathway.strip()
 
@@ -194,7 +364,7 @@ def sanitize_filename(pathway: str, replace_spaces: bool = True) -> str:
             pathway = pathway.replace(" ", "_")
 
         # Remove illegal characters
-        sanitized_filename = re.sub(r'[\\/*?:"<>|]', "", pathway)
+        sanitized_filename = pathway.translate(_ILLEGAL_FILENAME_CHARACTERS)
 
         # Limit filename length (optional, for example, to 255 characters)
         sanitized_filename = sanitized_filename[:255]
@@ -215,25 +385,16 @@ def filter_rows_containing_compound_keyword(df: pd.DataFrame, cols: List[str], k
             - nan_df: A DataFrame containing the rows where the values in all specified columns are empty strings or NaN.
 
     """
-    # Initialize an empty DataFrame to store the filtered rows
-    filtered_df = pd.DataFrame()
-    negative_filtered_df = pd.DataFrame()
-    nan_df = pd.DataFrame()
-    # Iterate through the rows of the original DataFrame
-    for index, row in df.iterrows():
-        # Iterate through the specified columns
-        if any(keyword in str(row[col]).lower() for col in cols):
-            # If the keyword is found, add the entire row to the filtered DataFrame
-            filtered_df = pd.concat([filtered_df, df.iloc[[index]]])
-
-        elif all((str(row[col]) == '' or str(row[col]) == 'nan' or row[col] != row[col]) for col in cols):
-            nan_df = pd.concat([nan_df, df.iloc[[index]]])
-        else:
-            negative_filtered_df = pd.concat([negative_filtered_df, df.iloc[[index]]])
-    # Reset the index of the filtered DataFrame
-    filtered_df.reset_index(drop=True, inplace=True)
-    negative_filtered_df.reset_index(drop=True, inplace=True)
-    nan_df.reset_index(drop=True, inplace=True)
+    # Rows are assigned to each output using whole-column masks, rather than checking each row in turn
+    values = df[cols]
+    as_strings = values.astype(str)
+    # Values are compared as lower case strings, so non-string values (e.g. numbers) can still match
+    keyword_found = as_strings.apply(lambda c: c.str.lower().str.contains(keyword, regex=False)).any(axis=1)
+    all_empty = ((as_strings == '') | (as_strings == 'nan') | values.isna()).all(axis=1)
+
+    filtered_df = df[keyword_found.to_numpy()].reset_index(drop=True)
+    negative_filtered_df = df[(~keyword_found & ~all_empty).to_numpy()].reset_index(drop=True)
+    nan_df = df[(~keyword_found & all_empty).to_numpy()].reset_index(drop=True)
 
     assert len(df.index) == (len(filtered_df.index) + len(negative_filtered_df.index)) + len(nan_df.index)
 
@@ -256,41 +417,34 @@ def fill_match_ids(df: pd.DataFrame, given_col: str) -> pd.DataFrame:
     df = df.copy(deep=True).dropna(subset=chem_id_cols, how='all')
     ### Fill in matching details for compound ID columns from other dataframes
     cols_to_do = [cl for cl in chem_id_cols if cl != given_col]
-    # Step 1: Create a mappings to match known pairs of IDs
-    mapping1 = {}
-    mapping2 = {}
-    for index, row in df.iterrows():
-        if row[given_col] == row[given_col]:  # If not nan
-            if row[cols_to_do[0]] == row[cols_to_do[0]]:
-                mapping1[row[cols_to_do[0]]] = row[given_col]
-            if row[cols_to_do[1]] == row[cols_to_do[1]]:
-                mapping2[row[cols_to_do[1]]] = row[given_col]
-
-    if any(x in mapping1.keys() for x in ['', np.nan, 'nan']):
+    # Step 1: Create a mappings to match known pairs of IDs. Where an ID is paired with multiple values, the last is used
+    known = df[given_col].notna()
+    mapping1 = df[known & df[cols_to_do[0]].notna()].drop_duplicates(subset=cols_to_do[0], keep='last').set_index(cols_to_do[0])[given_col]
+    mapping2 = df[known & df[cols_to_do[1]].notna()].drop_duplicates(subset=cols_to_do[1], keep='last').set_index(cols_to_do[1])[given_col]
+
+    if mapping1.index.isin(['', 'nan']).any():
         raise ValueError
-    if any(x in mapping2.keys() for x in ['', np.nan, 'nan']):
+    if mapping2.index.isin(['', 'nan']).any():
         raise ValueError
 
-    # Step 2: Iterate through the DataFrame to fill in the empty given_col values
-    for index, row in df.iterrows():
-        if row[given_col] != row[given_col]:
-            m1 = row[cols_to_do[0]]
-            m2 = row[cols_to_do[1]]
-            # prioritise inchikey and smiles
-            if m1 in mapping1:
-                v = mapping1[m1]
-                df.at[index, given_col] = v
-            elif m2 in mapping2:
-                v = mapping2[m2]
-                df.at[index, given_col] = v
+    # Step 2: Look up all the empty given_col values at once
+    # prioritise inchikey and smiles
+    fills = df[cols_to_do[0]].map(mapping1)
+    fills = fills.where(fills.notna(), df[cols_to_do[1]].map(mapping2))
+    to_fill = ~known & fills.notna()
+    if to_fill.any():
+        df[given_col] = df[given_col].where(~to_fill, fills)
 
     return df
 
 
+@lru_cache(maxsize=100_000)
 def get_compound_ids_from_CAS_ID_from_knapsack(cas_id: str):
     """
     Fetches compound identifiers (InChIKey and SMILES) associated with a given CAS ID from the Knapsack database.
 
+    Results are cached, so repeated IDs are only looked up once. Network errors are raised rather than returned, so aren't cached.
+
     This function constructs a URL to query the Knapsack database with a specified CAS ID. It retrieves
     data in the form of HTML tables, parses them, and extracts the relevant compound information such as
     InChIKey and SMILES. The function is robust to cases where the underlying web structure may have
@@ -311,17 +465,14 @@ def get_compound_ids_from_CAS_ID_from_knapsack(cas_id: str):
     """
     if cas_id == '' or cas_id is None:
         return None, None
-    url = f'http://www.knapsackfamily.com/knapsack_core/information.php?sname=CAS_ID&word={cas_id}'
-    time.sleep(.01)
+    url = _KNAPSACK_CAS_URL.format(cas_id=cas_id)
+    # Requests are only delayed when they exceed the rate limit
+    _KNAPSACK_RATE_LIMITER.wait()
+    # Fetched through the shared session so the connection is reused between IDs, rather than read_html opening a new one each time
+    response = _SESSION.get(url, timeout=_REQUEST_TIMEOUT)
+    response.raise_for_status()
     try:
-
-        tables = pd.read_html(url, flavor='html5lib')
-
-    except UnicodeEncodeError:
-        response = requests.get(url)
-        decoded = response.content.decode()
-        tables = pd.read_html(decoded, flavor='html5lib')
-
+        tables = pd.read_html(io.BytesIO(response.content), flavor='html5lib')
     except ValueError:
         return None, None
     meta_table = tables[0]
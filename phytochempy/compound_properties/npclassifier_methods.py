@@ -1,28 +1,34 @@
 import json
 import os
-import time
+import re
 import urllib
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 from typing import List
 
-import requests
 from tqdm import tqdm
 
+from phytochempy.compound_properties.generic_compound_functions import _SESSION, _REQUEST_TIMEOUT, _RateLimiter
+
 _NP_CLASSIFIER_COLUMNS = [
     'NPclassif_class_results', 'NPclassif_superclass_results',
     'NPclassif_pathway_results', 'NPclassif_isglycoside']
 NP_PATHWAYS = ['Terpenoids', 'Fatty acids', 'Polyketides', 'Carbohydrates', 'Amino acids and Peptides', 'Shikimates and Phenylpropanoids',
                'Alkaloids']
+# Classification is limited by waiting on the NPClassifier API, so SMILES are sent concurrently from a few threads
+_NPCLASSIFIER_WORKERS = 4
+# Maximum sustained rate of requests to the NPClassifier API, shared between all threads
+_NPCLASSIFIER_REQUESTS_PER_SECOND = 10
+_NPCLASSIFIER_RATE_LIMITER = _RateLimiter(_NPCLASSIFIER_REQUESTS_PER_SECOND)
 
 def get_npclassifier_result_columns_in_df(df: pd.DataFrame) -> List[str]:
-    out = []
-    for c in df.columns.tolist():
-        if any(x in c for x in _NP_CLASSIFIER_COLUMNS):
-            out.append(c)
-    return out
+    # Columns containing any of the result column names are found across the whole column index at once
+    result_pattern = '|'.join(re.escape(c) for c in _NP_CLASSIFIER_COLUMNS)
+    # Column labels are cast to strings, as the .str accessor isn't available for e.g. an empty RangeIndex
+    return df.columns[df.columns.astype(str).str.contains(result_pattern, regex=True)].tolist()
 
 
 def get_npclassifier_pathway_columns_in_df(df: pd.DataFrame) -> List[str]:
@@ -42,11 +48,13 @@ def get_npclassifier_pathway_columns_in_df(df: pd.DataFrame) -> List[str]:
 def npclassify_smiles(smiles: str) -> dict:
     # From https://ccms-ucsd.github.io/GNPSDocumentation/api/
     # Function to classify a single SMILES string
-    if smiles == smiles and smiles is not None:
-        time.sleep(0.1)  # check rate limiting
+    if pd.notna(smiles):
+        # Requests are only delayed when they exceed the rate limit
+        _NPCLASSIFIER_RATE_LIMITER.wait()
         safe_string = urllib.parse.quote(smiles)
         url = f"https://npclassifier.gnps2.org/classify?smiles={safe_string}"
-        response = requests.get(url)
+        # Connection errors are raised once the session's retries are used up, so an outage isn't mistaken for failed classifications
+        response = _SESSION.get(url, timeout=_REQUEST_TIMEOUT)
         if response.status_code == 200:
             return_dict = json.loads(response.text)
 
@@ -59,12 +67,9 @@ def npclassify_smiles(smiles: str) -> dict:
                         return_dict[k + '_' + str(i)] = val
                     return_dict[k] = ':'.join(return_dict[k])
 
-            for k in list(return_dict.keys())[:]:
-                return_dict['NPclassif_' + k] = return_dict[k]
-                del return_dict[k]
-
-            return_dict['npSMILES'] = smiles
-            return return_dict
+            renamed_dict = {'NPclassif_' + k: v for k, v in return_dict.items()}
+            renamed_dict['npSMILES'] = smiles
+            return renamed_dict
         else:
 
             return None
@@ -93,17 +98,17 @@ def get_npclassif_classes_from_smiles(smiles: List[str], npclassifier_cache_dir:
             already_known_smiles = set(existing_df['npSMILES'].tolist())
             unique_smiles = [s for s in unique_smiles if s not in already_known_smiles]
 
-    out_df = pd.DataFrame()
+    smiles_to_classify = [sm for sm in unique_smiles if sm is not None]
+    results = []
     failed_smiles = []
-    for sm in tqdm(unique_smiles):
-        if sm is not None:
-            result = npclassify_smiles(sm)
-
+    with ThreadPoolExecutor(max_workers=_NPCLASSIFIER_WORKERS) as executor:
+        for sm, result in zip(smiles_to_classify, tqdm(executor.map(npclassify_smiles, smiles_to_classify), total=len(smiles_to_classify))):
             if result is not None:
-                ent_df = pd.DataFrame(result, index=[0])
-                out_df = pd.concat([out_df, ent_df])
+                results.append(result)
             else:
                 failed_smiles.append(sm)
+    # Build the output once from all the results, rather than concatenating a dataframe for each
+    out_df = pd.DataFrame.from_records(results)
     if npclassifier_cache_dir is not None:
         if len(out_df.index) > 0:
             out_df.to_csv(os.path.join(npclassifier_cache_dir, temp_file_tag + str(uuid.uuid4()) + '.csv'))
@@ -162,15 +167,14 @@ def read_manual_npclassifier_input(npclassifier_output_file: str):
             rename_dict[c] = 'NPclassif_' + c
     np_classif_results = np_classif_results.rename(columns=rename_dict).dropna(subset='npSMILES')
 
+    split_columns = []
     for col in ['NPclassif_class_results', 'NPclassif_superclass_results',
                 'NPclassif_pathway_results']:
-        np_classif_results['col_split'] = np_classif_results[col].str.split(':')
-        max_splits = np_classif_results['col_split'].str.len().max()
-        if max_splits > 1:
-            # Create new columns for each substring
-            for i in range(max_splits):
-                np_classif_results[f'{col}_{i}'] = np_classif_results['col_split'].str.get(i)
-        else:
-            np_classif_results[f'{col}_{0}'] = np_classif_results['col_split'].str.get(0)
-    np_classif_results = np_classif_results.drop(columns=['col_split'])
+        # Create new columns for each substring
+        col_split = np_classif_results[col].str.split(':', expand=True)
+        col_split.columns = [f'{col}_{i}' for i in col_split.columns]
+        # Rows with fewer substrings are padded with None, so these are replaced with NaN as for other missing values
+        col_split = col_split.where(col_split.notna(), np.nan)
+        split_columns.append(col_split)
+    np_classif_results = pd.concat([np_classif_results] + split_columns, axis=1)
     return np_classif_results
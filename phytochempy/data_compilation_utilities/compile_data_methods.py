@@ -5,7 +5,7 @@ import pandas as pd
 from wcvpy.wcvp_download import wcvp_accepted_columns
 from wcvpy.wcvp_name_matching import get_genus_from_full_name, output_record_col_names
 
-from phytochempy.compound_properties import simplify_inchi_key, COMPOUND_NAME_COLUMN, fill_match_ids, standardise_SMILES, \
+from phytochempy.compound_properties import simplify_inchi_key_series, COMPOUND_NAME_COLUMN, fill_match_ids, standardise_SMILES_batch, \
     standardise_smiles_to_MAIP_smiles
 
 
@@ -31,7 +31,7 @@ def merge_and_tidy_compound_datasets(datasets: List[pd.DataFrame], output_csv: s
     print('Standardising SMILES')
     if 'Standard_SMILES' in all_metabolites_in_taxa.columns:
         raise ValueError(f'Standard_SMILES column already present in data.')
-    all_metabolites_in_taxa['Standard_SMILES'] = all_metabolites_in_taxa['SMILES'].apply(standardise_SMILES)
+    all_metabolites_in_taxa['Standard_SMILES'] = standardise_SMILES_batch(all_metabolites_in_taxa['SMILES'].tolist())
     print('Getting MAIP standardisation of SMILES')
     all_metabolites_in_taxa['MAIP_SMILES'] = all_metabolites_in_taxa['SMILES'].apply(standardise_smiles_to_MAIP_smiles)
     start_cols = ['accepted_name_w_author', COMPOUND_NAME_COLUMN, 'Standard_SMILES', 'MAIP_SMILES', 'SMILES', 'InChIKey', 'CAS ID', 'Source']
@@ -45,7 +45,7 @@ def merge_and_tidy_compound_datasets(datasets: List[pd.DataFrame], output_csv: s
     for c_id in ['Standard_SMILES', 'InChIKey', 'CAS ID']:
         all_metabolites_in_taxa = fill_match_ids(all_metabolites_in_taxa, c_id)
 
-    all_metabolites_in_taxa['InChIKey_simp'] = all_metabolites_in_taxa['InChIKey'].apply(simplify_inchi_key)
+    all_metabolites_in_taxa['InChIKey_simp'] = simplify_inchi_key_series(all_metabolites_in_taxa['InChIKey'])
 
     # Add genus column
     all_metabolites_in_taxa['Genus'] = all_metabolites_in_taxa[wcvp_accepted_columns['name']].apply(